@@ -5,23 +5,31 @@ import asyncio
 import datetime
 import logging
 import os
-import requests
+import socket
 import tempfile
-import time
-import wave
 
-from . import server, client
+import aiohttp
+
+from . import server, client, auth, tts_cache, scheduler, metrics, vad, workers, resilience, audio_format, prewarm, archive, trace, stt_speculation
 
 
 # region =============================================== The app context
 
 cli_args: argparse.Namespace
-token: str = ""
-token_expiration_timestamp: float = 0.0
+credential_pool: auth.CredentialPool            # The authorization keys with their access tokens
+tts_audio_cache: tts_cache.TtsCache
+prewarmer: prewarm.Prewarmer | None = None    # Fills the TTS cache in advance, if the phrase file is set
+audio_archive: archive.Archiver | None = None   # Keeps the intermediate audio files, if set
 token_expiration_time_delta: float = 30.0   # A protection interval before the expiration time, in seconds
-client_http_session = requests.Session()    # To reuse HTTP connections
+client_http_session: aiohttp.ClientSession   # To reuse HTTP connections; created within the event loop
+request_scheduler: scheduler.Scheduler      # To limit the number of concurrent requests to the cloud
+worker_number: int = 0                      # An index of the worker process in the multi-process mode
 recognize_api_resource: str = "/speech:recognize"
 synthesize_api_resource: str = "/text:synthesize"
+upload_api_resource: str = "/data:upload"
+async_recognize_api_resource: str = "/speech:async_recognize"
+task_api_resource: str = "/task:get"
+download_api_resource: str = "/data:download"
 LOGGER: logging.Logger
 
 
@@ -32,8 +40,61 @@ def start() -> None:
     """ Start the app """
 
     LOGGER.info('Wyoming-Salutespeech Gateway is starting.')
-    client.setup_ca_cert()
-    asyncio.run( server.run() )
+    if cli_args.workers > 1:
+        workers.run_supervisor()
+    else:
+        asyncio.run( _run() )
+
+
+async def _run(listen_socket: socket.socket | None = None, shared_tokens: list[auth.SharedToken] | None = None) -> None:
+    """ Run the app within the event loop. A worker process gets the listening socket and the access tokens from the supervisor """
+
+    global credential_pool, request_scheduler, tts_audio_cache, prewarmer, audio_archive
+    await client.open_http_session()
+    request_scheduler = scheduler.create_scheduler()
+    credential_pool = auth.create_credential_pool(shared_tokens)
+    tts_audio_cache = tts_cache.TtsCache()
+    metrics.add_stats_collector('tts_cache', 'TTS cache stats', tts_audio_cache.get_stats)
+    metrics.add_stats_collector('scheduler', 'Upstream request scheduler stats', request_scheduler.get_stats)
+    metrics.add_stats_collector('vad', 'Voice activity detector stats', lambda: {'saved_bytes': vad.saved_bytes_total})
+    metrics.add_stats_collector('stt_speculation', 'Speculative recognition stats', stt_speculation.get_stats)
+    metrics.add_stats_collector('credentials', 'Authorization key usage stats', credential_pool.get_stats)
+    metrics.add_stats_collector('resilience', 'Cloud request retry, hedging and circuit breaker stats', resilience.get_stats)
+    if cli_args.prewarm_file and worker_number == 0:    # The workers share the disk cache; one of them fills it
+        prewarmer = prewarm.Prewarmer(cli_args.prewarm_file)
+        metrics.add_stats_collector('prewarm', 'TTS cache pre-warming stats', prewarmer.get_stats)
+    if cli_args.keep_audio_files:
+        archive_dir = cli_args.download_dir if cli_args.workers <= 1 else os.path.join(cli_args.download_dir, f"worker{worker_number}")
+        audio_archive = archive.Archiver(archive_dir)
+        metrics.add_stats_collector('archive', 'Audio archive stats', audio_archive.get_stats)
+    metrics_runner = None
+    storage_task = asyncio.create_task( _open_storage() )   # Scanning slow storage, like an SD card, must not delay the bind
+    try:
+        metrics_runner = await metrics.start_server()
+        credential_pool.start()     # Warm up the tokens before the first voice request
+        trace.start_export()
+        if prewarmer:
+            prewarmer.start()
+        await server.run(listen_socket)
+    finally:
+        storage_task.cancel()
+        if prewarmer:
+            await prewarmer.stop()
+        await credential_pool.stop()
+        await trace.stop_export()
+        await client.close_http_session()
+        if audio_archive:
+            await audio_archive.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+async def _open_storage() -> None:
+    """Account the TTS cache and the audio archive items stored by previous runs. They are usable meanwhile"""
+
+    await tts_audio_cache.open()
+    if audio_archive:
+        await audio_archive.open()
 
 
 # endregion
@@ -45,7 +106,7 @@ def parse_arguments() -> None:
     global cli_args
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--auth-key", default="", help="SberDevices authorization key for the SaluteSpeech service")
+    parser.add_argument("--auth-key", action="append", default=[], help="SberDevices authorization key for the SaluteSpeech service; may be repeated to spread the requests over several accounts")
     parser.add_argument("--listen-uri", default="tcp://0.0.0.0:9999", help="Wyoming server URI to listen to, like 'tcp://0.0.0.0:9999'")
     parser.add_argument("--sber-auth-url", default="https://ngw.devices.sberbank.ru:9443/api/v2/oauth", help="SberDevices authorization URL")
     parser.add_argument("--salutespeech-url", default="https://smartspeech.sber.ru/rest/v1", help="SaluteSpeech service URL")
@@ -53,8 +114,64 @@ def parse_arguments() -> None:
     parser.add_argument("--salutespeech-voice", default="Ost_24000", help="SaluteSpeech synth voice: 'Ost_24000', 'May_24000' etc.")
     parser.add_argument("--keep-audio-files", action="store_true", help="Keep intermediate audio files, if set")
     parser.add_argument("--download-dir", default=tempfile.TemporaryDirectory().name, help="A directory to temporarily store intermediate audio files")
+    parser.add_argument("--archive-codec", default="wav", choices=["wav", "flac"], help="Format of the kept audio files; 'flac' requires the 'soundfile' package")
+    parser.add_argument("--archive-max-size", type=int, default=1024, help="Max size of the kept audio files, in MB; the oldest files are removed. 0 means no limit. Applies per worker")
+    parser.add_argument("--archive-max-age", type=float, default=604800.0, help="Lifetime of the kept audio files, in seconds; 0 means no limit")
+    parser.add_argument("--archive-queue-size", type=int, default=100, help="Max number of audio files waiting to be written; more are dropped, not to slow down the requests")
     parser.add_argument("--language", default="ru-RU", help="Transcription language, like 'ru-RU'")
-    parser.add_argument("--chunk-size", type=int, default=1024, help="Number of samples per Wyoming audio chunk")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Min number of samples per Wyoming audio chunk; the chunks grow while a client keeps up")
+    parser.add_argument("--max-chunk-size", type=int, default=8192, help="Max number of samples per Wyoming audio chunk; set to '--chunk-size' for fixed chunks")
+    parser.add_argument("--write-batch-size", type=int, default=64, help="Audio sent to a Wyoming client in a single socket write, in KB")
+    parser.add_argument("--http-pool-size", type=int, default=10, help="Max number of pooled keep-alive connections to the cloud services")
+    parser.add_argument("--http-keepalive-timeout", type=float, default=30.0, help="Idle keep-alive connection lifetime, in seconds")
+    parser.add_argument("--http-connect-timeout", type=float, default=10.0, help="Cloud service connection timeout, in seconds")
+    parser.add_argument("--http-timeout", type=float, default=60.0, help="Cloud service request total timeout, in seconds")
+    parser.add_argument("--max-concurrent-requests", type=int, default=10, help="Max number of concurrent requests to the cloud services")
+    parser.add_argument("--max-concurrent-stt-requests", type=int, default=8, help="Max number of concurrent recognition requests")
+    parser.add_argument("--max-concurrent-tts-requests", type=int, default=6, help="Max number of concurrent synthesis requests")
+    parser.add_argument("--max-queued-requests", type=int, default=50, help="Max number of requests waiting for a slot; more requests are rejected at once")
+    parser.add_argument("--request-deadline", type=float, default=5.0, help="Base deadline of a cloud request including its retries, in seconds; longer audio or text adds to it. A streamed recognition is timed from the audio end")
+    parser.add_argument("--stt-deadline-per-second", type=float, default=0.5, help="Recognition request deadline added per second of audio, in seconds")
+    parser.add_argument("--tts-deadline-per-char", type=float, default=0.02, help="Synthesis request deadline added per character of text, in seconds")
+    parser.add_argument("--retries", type=int, default=2, help="Max number of retries of a failed cloud request")
+    parser.add_argument("--retry-budget", type=float, default=0.2, help="Max share of the cloud requests retried or hedged, not to multiply the load on a failing service")
+    parser.add_argument("--hedging", action="store_true", help="Send a second cloud request if the first one is slower than 95%% of the recent ones, if set")
+    parser.add_argument("--circuit-breaker-threshold", type=int, default=5, help="Number of cloud request failures in a row making the gateway fail requests fast; 0 disables it")
+    parser.add_argument("--circuit-breaker-timeout", type=float, default=30.0, help="How long to fail requests fast before probing the cloud service again, in seconds")
+    parser.add_argument("--key-rate", type=float, default=0.0, help="Max number of cloud requests per second per authorization key; 0 means no limit. Applies per worker")
+    parser.add_argument("--key-burst", type=int, default=5, help="Number of cloud requests per authorization key let through at once over the '--key-rate'")
+    parser.add_argument("--key-ejection-time", type=float, default=60.0, help="How long not to use an authorization key after a quota error (403 or 429), in seconds")
+    parser.add_argument("--token-refresh-lead", type=float, default=60.0, help="How long before the expiration to refresh the access token in the background, in seconds")
+    parser.add_argument("--auth-retries", type=int, default=5, help="Max number of retries of a failed access token request")
+    parser.add_argument("--tts-cache-memory-size", type=int, default=32, help="Max size of synthesized audio cached in memory, in MB; 0 disables the memory cache")
+    parser.add_argument("--tts-cache-dir", default="", help="A directory to persistently cache synthesized audio; the disk cache is disabled if not set")
+    parser.add_argument("--tts-cache-disk-size", type=int, default=512, help="Max size of synthesized audio cached on disk, in MB; shared by the worker processes")
+    parser.add_argument("--tts-cache-ttl", type=float, default=2592000.0, help="Lifetime of synthesized audio cached on disk, in seconds")
+    parser.add_argument("--prewarm-file", default="", help="A file of phrases to synthesize into the TTS cache in advance, one per line, like 'May_24000|Свет выключен'; re-read on SIGHUP")
+    parser.add_argument("--prewarm-rate", type=float, default=10.0, help="Max number of phrases pre-warmed per minute; only while no other cloud request is in progress. 0 means no limit")
+    parser.add_argument("--prewarm-interval", type=float, default=3600.0, help="How often to re-read the pre-warm file and synthesize the phrases missing in the cache, in seconds")
+    parser.add_argument("--max-utterance-duration", type=float, default=300.0, help="Max duration of audio to recognize, in seconds; the rest of a longer utterance is dropped")
+    parser.add_argument("--async-recognition-threshold", type=float, default=55.0, help="Recognize longer utterances with the asynchronous API having no duration limit, in seconds; 0 disables it. Not used with '--stt-streaming'")
+    parser.add_argument("--vad", action="store_true", help="Detect voice activity to trim silence before uploading audio for recognition, if set")
+    parser.add_argument("--vad-threshold", type=float, default=-40.0, help="Audio level considered speech by the voice activity detector, in dBFS")
+    parser.add_argument("--vad-padding", type=float, default=0.3, help="Silence kept around the detected speech, in seconds")
+    parser.add_argument("--vad-end-silence", type=float, default=0.0, help="Silence after speech ending the utterance before the client stops the audio, in seconds; 0 disables it")
+    parser.add_argument("--upload-codec", default="pcm", choices=["pcm", "flac", "opus"], help="Compress audio uploaded for recognition; requires the 'soundfile' package, except for 'pcm'")
+    parser.add_argument("--stt-streaming", action="store_true", help="Upload audio to the recognition service while it is still being received, if set")
+    parser.add_argument("--stt-speculation", action="store_true", help="Recognize the audio received so far on speech pauses, to have the transcript before the client stops the audio, if set. Costs extra recognition requests; not used with '--stt-streaming'")
+    parser.add_argument("--stt-speculation-pause", type=float, default=0.3, help="Speech pause starting a speculative recognition, in seconds; 0 disables it")
+    parser.add_argument("--stt-speculation-interval", type=float, default=0.0, help="Speech duration starting a speculative recognition since the previous one, in seconds; 0 disables it")
+    parser.add_argument("--stt-speculation-max-requests", type=int, default=3, help="Max number of speculative recognitions of an utterance")
+    parser.add_argument("--tts-output-format", type=audio_format.parse_format, default="24000:2:1", help="Synthesized audio format sent to Wyoming clients, like '16000:2:1' (rate, width, channels); converted by the gateway unless synthesized natively")
+    parser.add_argument("--tts-client-format", type=audio_format.parse_client_format, action="append", default=[], help="Synthesized audio format of a Wyoming client by its address, like '192.168.1.10=16000:2:1'; may be repeated")
+    parser.add_argument("--tts-streaming", action="store_true", help="Synthesize long texts sentence by sentence and send audio as soon as the first sentence is ready, if set")
+    parser.add_argument("--tts-stream-parallelism", type=int, default=3, help="Max number of sentences of a text synthesized concurrently in the streaming mode")
+    parser.add_argument("--tts-stream-min-segment-length", type=int, default=40, help="Min length of a text segment synthesized separately in the streaming mode, in characters")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes sharing the listening socket; the request limits apply per worker")
+    parser.add_argument("--shutdown-timeout", type=float, default=10.0, help="How long a stopping worker lets the clients finish the requests in progress, in seconds")
+    parser.add_argument("--metrics-uri", default="", help="URI to serve Prometheus metrics at '/metrics', like 'tcp://0.0.0.0:9998'; disabled if not set. Each worker uses the next port")
+    parser.add_argument("--trace-file", default="", help="A file to append the timing records of the utterances and syntheses to, as JSON lines; not exported if not set. The records are logged at the 'INFO' level as well")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0, help="Share of the timing records appended to the trace file, from 0 to 1")
     parser.add_argument("--log-level", default="WARNING", help="Log level, like 'ERROR', 'INFO', 'DEBUG' etc.")
 
     cli_args = parser.parse_args()
@@ -77,28 +194,4 @@ def get_time_from_timestamp(timestamp: float):
     """ Get a human-readable time string from the unix (epoch) time number"""
     return datetime.datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
 
-
-def check_if_token_expired() -> bool:
-    """Check if the authentication token expired. Returns True if the token is expired"""
-
-    global token_expiration_timestamp, token_expiration_time_delta
-    current_time: int = int( time.time() )
-    result: bool = current_time > token_expiration_timestamp - token_expiration_time_delta
-    return result
-
-
-def write_wav(prefix: str, audio: bytes, framerate: float) -> None:
-    """ Write pcm audio data to a wav file """
-
-    filename = os.path.join(cli_args.download_dir, f"{prefix}{ datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3] }.wav")
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-    wav_file: wave.Wave_write = wave.open(filename, "wb")
-    with wav_file:
-        wav_file.setnchannels(1)
-        wav_file.setsampwidth(2)
-        wav_file.setframerate(framerate)
-        wav_file.writeframes(audio)
-    LOGGER.debug(f"Audio is written to the file {filename}")
-
 # endregion
\ No newline at end of file
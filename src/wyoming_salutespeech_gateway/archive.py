@@ -0,0 +1,209 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import datetime
+import os
+import re
+import time
+import wave
+from collections import deque
+from typing import NamedTuple
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:     # An optional dependency; the audio is archived as WAV without it
+    soundfile = None
+
+from . import app
+
+
+_MAX_BATCH: int = 32               # Max number of clips written by a single worker thread call
+_STOP_TIMEOUT: float = 5.0         # How long a stopping archiver writes the queued clips, in seconds
+_DROP_WARNING_INTERVAL: float = 60.0    # Not to flood the log while the storage does not keep up, in seconds
+_EXTENSIONS: dict[str, str] = {'wav': '.wav', 'flac': '.flac'}
+_PREFIXES: tuple[str, ...] = ('to_be_recognized_', 'synthesized_')
+_SUBDIR_FORMAT: str = "%Y%m%d-%H"
+_SUBDIR_PATTERN = re.compile(r'\d{8}-\d{2}')    # The subdirectory names the archiver makes; anything else in the directory is not its own
+
+
+class Clip(NamedTuple):
+    """Audio to archive"""
+
+    prefix: str
+    audio: bytes
+    framerate: int
+    timestamp: float
+
+
+# region =============================================== Subroutines
+
+def _write_clip(path: str, clip: Clip, codec: str) -> None:
+    """Write 16-bit mono PCM audio to a file. Blocking"""
+
+    if codec == 'flac':
+        soundfile.write(path, np.frombuffer(clip.audio, dtype='<i2'), clip.framerate, format='FLAC', subtype='PCM_16')
+        return
+    wav_file: wave.Wave_write = wave.open(path, "wb")
+    with wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(clip.framerate)
+        wav_file.writeframes(clip.audio)
+
+
+def _is_archived_file(name: str) -> bool:
+    """Check if the file name is of an archived clip"""
+
+    return name.startswith(_PREFIXES) and name.endswith( tuple(_EXTENSIONS.values()) )
+
+
+# endregion
+# region =============================================== Interface
+
+class Archiver:
+    """Keeps the recognized and synthesized audio for debugging without slowing down the requests.
+    The clips are queued and written by a background task in batches, into a subdirectory per hour;
+    the oldest files are removed beyond the size and age limits. If the storage does not keep up, new clips are dropped"""
+
+    def __init__(self, directory: str) -> None:
+        """ Constructor """
+
+        self._directory = directory
+        self._codec = app.cli_args.archive_codec if soundfile is not None else 'wav'
+        self._max_bytes = app.cli_args.archive_max_size * 1024 * 1024
+        self._max_age = app.cli_args.archive_max_age
+        self._queue: asyncio.Queue[Clip] = asyncio.Queue(app.cli_args.archive_queue_size)
+        self._files: deque[tuple[str, int, float]] = deque()    # (path, size, modification time), the oldest first
+        self._task: asyncio.Task | None = None
+        self._dropped_warned_at: float = 0.0
+        self.size: int = 0
+        self.written: int = 0
+        self.dropped: int = 0
+        self.failed: int = 0
+        self.removed: int = 0
+
+
+    async def open(self) -> None:
+        """Account the files archived by previous runs and start writing in the background"""
+
+        if self._codec != app.cli_args.archive_codec:
+            app.LOGGER.warning("The 'soundfile' package is not installed; archiving WAV instead of '%s'.", app.cli_args.archive_codec)
+        await asyncio.to_thread(self._scan)
+        self._task = asyncio.create_task(self._run())
+
+
+    async def close(self) -> None:
+        """Write the queued clips, within the timeout, and stop"""
+
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), _STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            app.LOGGER.warning("%s audio clips are not archived in time.", self._queue.qsize())
+        self._task.cancel()
+        self._task = None
+
+
+    def submit(self, prefix: str, audio: bytes | memoryview, framerate: int) -> None:
+        """Queue the audio to archive. Never waits: the clip is dropped if the queue is full"""
+
+        try:
+            self._queue.put_nowait( Clip(prefix, bytes(audio), framerate, time.time()) )   # A copy: the caller may reuse the buffer
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if time.time() - self._dropped_warned_at > _DROP_WARNING_INTERVAL:
+                self._dropped_warned_at = time.time()
+                app.LOGGER.warning("The audio archive does not keep up; %s clips are dropped so far.", self.dropped)
+
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the archive counters"""
+
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'removed': self.removed,
+            'size': self.size,
+        }
+
+
+    async def _run(self) -> None:
+        """Write the queued clips, taking all the clips queued meanwhile as a batch"""
+
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < _MAX_BATCH and not self._queue.empty():
+                batch.append( self._queue.get_nowait() )
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+    def _write_batch(self, batch: list[Clip]) -> None:
+        """Write the clips, then remove the files beyond the limits. Blocking"""
+
+        for clip in batch:
+            moment = datetime.datetime.fromtimestamp(clip.timestamp)
+            path = os.path.join(self._directory, moment.strftime(_SUBDIR_FORMAT), f"{clip.prefix}{moment.strftime('%Y%m%d-%H%M%S-%f')[:-3]}{_EXTENSIONS[self._codec]}")
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _write_clip(path, clip, self._codec)
+                size = os.path.getsize(path)
+            except (OSError, RuntimeError) as err:  # libsndfile errors are RuntimeError subclasses
+                self.failed += 1
+                app.LOGGER.debug("Failed to archive audio to the file %s: %s.", path, err)
+                continue
+            self._files.append( (path, size, clip.timestamp) )
+            self.size += size
+            self.written += 1
+            app.LOGGER.debug("Audio is written to the file %s", path)
+        self._apply_retention()
+
+
+    def _scan(self) -> None:
+        """Account the files archived by previous runs, the oldest first. Other files in the directory are left alone. Blocking"""
+
+        os.makedirs(self._directory, exist_ok=True)
+        files = []
+        for subdir in os.scandir(self._directory):
+            if subdir.is_dir(follow_symlinks=False) and _SUBDIR_PATTERN.fullmatch(subdir.name):
+                for entry in os.scandir(subdir.path):
+                    if entry.is_file(follow_symlinks=False) and _is_archived_file(entry.name):
+                        stat = entry.stat()
+                        files.append( (entry.path, stat.st_size, stat.st_mtime) )
+        files.sort(key=lambda file: file[2])
+        self._files.extend(files)
+        self.size = sum(file[1] for file in files)
+        self._apply_retention()
+
+
+    def _apply_retention(self) -> None:
+        """Remove the oldest archived files beyond the size limit and the ones older than the age limit, then the hourly subdirectories left empty. Blocking"""
+
+        removed_dirs = set()
+        while self._files and ((self._max_bytes and self.size > self._max_bytes) or (self._max_age and time.time() - self._files[0][2] > self._max_age)):
+            path, size, _ = self._files.popleft()
+            self.size -= size
+            self.removed += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            removed_dirs.add( os.path.dirname(path) )
+        for path in removed_dirs:
+            if not _SUBDIR_PATTERN.fullmatch( os.path.basename(path) ):
+                continue
+            try:
+                os.rmdir(path)
+            except OSError:     # Not empty yet
+                pass
+
+
+# endregion
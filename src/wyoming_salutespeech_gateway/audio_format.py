@@ -0,0 +1,131 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+from typing import NamedTuple
+
+import numpy as np
+
+from . import app
+
+
+_LOW_PASS_TAPS: int = 63    # Length of the anti-aliasing filter applied before downsampling
+_SAMPLE_TYPES: dict[int, type] = {1: np.int8, 2: np.int16, 4: np.int32}     # Sample value ranges by the width
+_UNSIGNED_WIDTH: int = 1    # 8-bit PCM is unsigned with the 128 bias, as in WAV and the Wyoming converter
+
+
+class AudioFormat(NamedTuple):
+    """A PCM audio format"""
+
+    rate: int
+    width: int
+    channels: int
+
+
+NATIVE_FORMAT = AudioFormat(rate=24000, width=2, channels=1)        # Synthesized by the '<name>_24000' voices
+NARROWBAND_FORMAT = AudioFormat(rate=8000, width=2, channels=1)     # Synthesized by the '<name>_8000' voices
+
+
+# region =============================================== Subroutines
+
+def _resample(samples: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+    """Resample the float samples by linear interpolation, low-pass filtering them first when downsampling"""
+
+    if target_rate < source_rate:
+        cutoff = target_rate / source_rate / 2     # The target Nyquist frequency relative to the source rate
+        offsets = np.arange(_LOW_PASS_TAPS) - (_LOW_PASS_TAPS - 1) / 2
+        taps = np.sinc(2 * cutoff * offsets) * np.hamming(_LOW_PASS_TAPS)
+        samples = np.convolve(samples, taps / taps.sum(), mode='same')
+    target_length = len(samples) * target_rate // source_rate
+    positions = np.arange(target_length) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples)
+
+
+def _decode(audio: bytes, width: int) -> np.ndarray:
+    """Get the PCM samples as signed values"""
+
+    if width == _UNSIGNED_WIDTH:
+        return np.frombuffer(audio, dtype=np.uint8).astype(np.int16) - 128
+    return np.frombuffer(audio, dtype=_SAMPLE_TYPES[width])
+
+
+def _encode(samples: np.ndarray, width: int) -> bytes:
+    """Get the PCM audio of the float samples in [-1, 1]"""
+
+    sample_type = _SAMPLE_TYPES[width]
+    target_max = np.iinfo(sample_type).max
+    samples = np.clip(np.round(samples * target_max), -target_max - 1, target_max)
+    if width == _UNSIGNED_WIDTH:
+        return (samples + 128).astype(np.uint8).tobytes()
+    return samples.astype(sample_type).tobytes()
+
+
+# endregion
+# region =============================================== Interface
+
+def parse_format(value: str) -> AudioFormat:
+    """Parse a format like '16000:2:1' (rate, width, channels); the width and channels may be omitted, like '16000'"""
+
+    parts = [int(part) for part in value.split(':')]
+    audio_format = AudioFormat(*parts, *NATIVE_FORMAT[len(parts):])
+    if audio_format.width not in _SAMPLE_TYPES or audio_format.rate <= 0 or audio_format.channels <= 0:
+        raise ValueError(f"Unsupported audio format: '{value}'")
+    return audio_format
+
+
+def parse_client_format(value: str) -> tuple[str, AudioFormat]:
+    """Parse a client format like '192.168.1.10=16000:2:1' (the client address and the format)"""
+
+    host, separator, format_value = value.partition('=')
+    if not separator or not host:
+        raise ValueError(f"A client address is expected, like '192.168.1.10=16000': '{value}'")
+    return host, parse_format(format_value)
+
+
+def get_client_format(client_host: str | None) -> AudioFormat:
+    """Get the synthesized audio format a Wyoming client plays, configured by its address or for all the clients"""
+
+    for host, client_format in app.cli_args.tts_client_format:
+        if host == client_host:
+            return client_format
+    return app.cli_args.tts_output_format
+
+
+def get_source_format(target_format: AudioFormat) -> AudioFormat:
+    """Get the closest format the cloud service synthesizes natively"""
+
+    return NARROWBAND_FORMAT if target_format.rate <= NARROWBAND_FORMAT.rate else NATIVE_FORMAT
+
+
+def get_voice(voice: str, source_format: AudioFormat) -> str:
+    """Get the voice variant synthesizing the format, like 'Ost_8000' for 'Ost_24000'"""
+
+    name, separator, rate = voice.rpartition('_')
+    if separator and rate.isdigit():
+        return f"{name}_{source_format.rate}"
+    return voice
+
+
+def convert(audio: bytes, source_format: AudioFormat, target_format: AudioFormat) -> bytes:
+    """Convert the audio to the format: resample it, change the sample width and duplicate the channels. Blocking"""
+
+    if source_format == target_format or not audio:
+        return audio
+    source_max = np.iinfo(_SAMPLE_TYPES[source_format.width]).max
+    samples = _decode(audio, source_format.width)
+    samples = samples.reshape(-1, source_format.channels).mean(axis=1) / source_max     # Mono float in [-1, 1]
+    if source_format.rate != target_format.rate:
+        samples = _resample(samples, source_format.rate, target_format.rate)
+    if target_format.channels > 1:
+        samples = np.repeat(samples, target_format.channels)   # Interleaved identical channels
+    return _encode(samples, target_format.width)
+
+
+async def convert_async(audio: bytes, source_format: AudioFormat, target_format: AudioFormat) -> bytes:
+    """Convert the audio to the format in a worker thread, not to block the event loop"""
+
+    if source_format == target_format:
+        return audio
+    return await asyncio.to_thread(convert, audio, source_format, target_format)
+
+
+# endregion
@@ -0,0 +1,84 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import json
+import time
+
+from wyoming.audio import AudioChunk
+from wyoming.version import __version__ as wyoming_version
+
+from . import app, metrics
+
+
+_SLOW_DRAIN_SECONDS: float = 0.02   # A flush waiting longer means the client or the network does not keep up
+_MAX_CACHED_HEADERS: int = 64       # The last chunk of each audio segment has an arbitrary length
+
+
+class AudioWriter:
+    """Sends audio to a Wyoming client as 'audio-chunk' events, coalescing many events into a single socket write.
+    The chunk size grows while the client keeps up and shrinks back when the writes stall"""
+
+    def __init__(self, writer: asyncio.StreamWriter, rate: int, width: int, channels: int) -> None:
+        """ Constructor """
+
+        self._writer = writer
+        self._bytes_per_sample = width * channels
+        self._data = json.dumps(AudioChunk(rate=rate, width=width, channels=channels, audio=b"").event().data, ensure_ascii=False).encode('utf-8')
+        self._min_chunk_size = app.cli_args.chunk_size
+        self._max_chunk_size = max(app.cli_args.chunk_size, app.cli_args.max_chunk_size)
+        self._flush_size = app.cli_args.write_batch_size * 1024
+        self.chunk_size: int = self._min_chunk_size     # In samples; kept across the syntheses of a connection
+        self._headers: dict[int, bytes] = {}    # Event header lines by the payload length; most chunks have the same length
+        self._pending: list[bytes | memoryview] = []
+        self._pending_size = 0
+
+
+    async def write(self, audio: bytes) -> None:
+        """Send the audio, flushing the events whenever the batch is full, and at the end. The chunks are slices, not copies"""
+
+        audio_view = memoryview(audio)
+        offset = 0
+        while offset < len(audio_view):
+            chunk = audio_view[offset: offset + self.chunk_size * self._bytes_per_sample]    # The size adapts on every flush
+            offset += len(chunk)
+            self._pending.extend( (self._get_header(len(chunk)), self._data, chunk) )
+            self._pending_size += len(chunk)
+            if self._pending_size >= self._flush_size:
+                await self.flush()
+        await self.flush()
+
+
+    async def flush(self) -> None:
+        """Send the pending events in a single write, then adapt the chunk size to how fast the client receives them"""
+
+        if not self._pending:
+            return
+        start_time = time.time()
+        self._writer.writelines(self._pending)
+        metrics.audio_sent_bytes.inc(self._pending_size)
+        self._pending = []
+        self._pending_size = 0
+        await self._writer.drain()
+        drain_time = time.time() - start_time
+        metrics.chunk_send_seconds.observe(drain_time)
+        if drain_time > _SLOW_DRAIN_SECONDS:
+            self.chunk_size = max(self._min_chunk_size, self.chunk_size // 2)
+        else:
+            self.chunk_size = min(self._max_chunk_size, self.chunk_size * 2)
+
+
+    def _get_header(self, payload_length: int) -> bytes:
+        """Get the event header line, the same as the Wyoming library writes"""
+
+        header = self._headers.get(payload_length)
+        if header is None:
+            if len(self._headers) >= _MAX_CACHED_HEADERS:
+                self._headers.clear()
+            header = json.dumps({
+                'type': 'audio-chunk',
+                'version': wyoming_version,
+                'data_length': len(self._data),
+                'payload_length': payload_length,
+            }).encode('utf-8') + b"\n"
+            self._headers[payload_length] = header
+        return header
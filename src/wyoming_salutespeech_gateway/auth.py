@@ -0,0 +1,361 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import json
+import multiprocessing.context
+import random
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator
+from uuid import uuid4
+
+import aiohttp
+
+from . import app, metrics
+
+
+_RETRY_BASE_DELAY: float = 0.5     # A delay before the first retry of a failed token request, in seconds
+_RETRY_MAX_DELAY: float = 30.0     # An upper bound of the exponential retry delay, in seconds
+_SHARED_TOKEN_MAX_SIZE: int = 8192  # Shared memory reserved for the token, in bytes; SberDevices tokens take about 1 KB
+_SHARED_TOKEN_POLL_INTERVAL: float = 0.1    # How often a worker checks for a new token it waits for, in seconds
+_QUOTA_STATUSES: frozenset[int] = frozenset({403, 429})    # The account is out of its quota or its request rate limit
+
+
+class TokenManager:
+    """Keeps the SberDevices access token fresh, refreshing it in the background ahead of the expiration"""
+
+    def __init__(self, auth_key: str, shared_token: 'SharedToken | None' = None) -> None:
+        """ Constructor """
+
+        self._auth_key = auth_key
+        self._shared_token = shared_token   # Where to publish the token for the worker processes, in the multi-process mode
+        self.token: str = ""
+        self.expiration_timestamp: float = 0.0
+        if shared_token is not None:
+            self.token, self.expiration_timestamp = shared_token.read()  # Survive a restart without re-authenticating
+        self._refresh_task: asyncio.Task | None = None      # An in-flight refresh shared by all the callers
+        self._refresher_task: asyncio.Task | None = None    # A background loop refreshing the token ahead of time
+
+
+    def is_expired(self) -> bool:
+        """Check if the token expired, taking into account the protection interval. Returns True if the token is expired"""
+
+        return time.time() > self.expiration_timestamp - app.token_expiration_time_delta
+
+
+    async def get_token(self) -> str:
+        """Get a valid token. A caller waits for a refresh only if there is no valid token at all"""
+
+        if not self.is_expired():
+            return self.token
+        app.LOGGER.debug("Access token is expired, waiting for a new one.")
+        return await self.refresh()
+
+
+    async def refresh(self) -> str:
+        """Refresh the token. Concurrent callers share a single in-flight refresh"""
+
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._fetch_with_retries())
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        return await asyncio.shield(self._refresh_task)
+
+
+    def start(self) -> None:
+        """Start refreshing the token in the background"""
+
+        if self._refresher_task is None:
+            self._refresher_task = asyncio.create_task(self._run_refresher())
+
+
+    async def stop(self) -> None:
+        """Stop refreshing the token in the background"""
+
+        for task in (self._refresher_task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+        self._refresher_task = None
+
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        """Let the next caller start a new refresh"""
+
+        if self._refresh_task is task:
+            self._refresh_task = None
+
+
+    async def _run_refresher(self) -> None:
+        """Refresh the token ahead of the expiration, so voice requests never wait for it"""
+
+        while True:
+            refresh_timestamp = self.expiration_timestamp - app.token_expiration_time_delta - app.cli_args.token_refresh_lead
+            delay = refresh_timestamp - time.time()
+            if delay > 0:
+                app.LOGGER.debug("The next access token refresh is scheduled at %s.", app.get_time_from_timestamp(refresh_timestamp))
+                await asyncio.sleep(delay)
+            if not await self.refresh():
+                await asyncio.sleep(_RETRY_MAX_DELAY)   # All retries are exhausted; let the service recover
+
+
+    async def _fetch_with_retries(self) -> str:
+        """Get a new token, retrying with a jittered exponential backoff. Returns an empty string on failure"""
+
+        for attempt in range(app.cli_args.auth_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2 ** attempt))  # Full jitter
+                app.LOGGER.debug("Retrying to get an access token in %.2f seconds.", delay)
+                await asyncio.sleep(delay)
+            if await self._fetch():
+                return self.token
+        return ''
+
+
+    async def _fetch(self) -> bool:
+        """Request a new token from the authorization service. Returns True on success"""
+
+        url = app.cli_args.sber_auth_url
+        payload = 'scope=SALUTE_SPEECH_PERS'
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+            'RqUID': str( uuid4() ),
+            'Authorization': f'Basic {self._auth_key}'
+        }
+        start_time = time.time()
+        try:
+            async with app.client_http_session.post(url, headers=headers, data=payload, trace_request_ctx=SimpleNamespace(kind='auth')) as response:
+                status, body = response.status, await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            app.LOGGER.debug("Failed to get an access token: %s: %s.", type(err).__name__, err)
+            return False
+        finally:
+            metrics.token_fetch_seconds.observe(time.time() - start_time)
+
+        if status == 200:
+            response_json = json.loads(body)
+            self.token = response_json.get('access_token')
+            self.expiration_timestamp = float( response_json.get('expires_at') ) / 1000 # Sber cloud sends the epoch timestamp in milliseconds
+            if self._shared_token is not None:
+                self._shared_token.publish(self.token, self.expiration_timestamp)
+            app.LOGGER.debug("Access token is successfully received.")
+            app.LOGGER.debug("The new token expiration time: %s", app.get_time_from_timestamp(self.expiration_timestamp))
+            return True
+        else:
+            app.LOGGER.debug("Failed to get an access token: response status code: %s, response text: '%s'.", status, body.decode(errors='replace'))
+            return False
+
+
+class SharedToken:
+    """An access token in shared memory, fetched by one process and used by the others"""
+
+    def __init__(self, context: multiprocessing.context.BaseContext) -> None:
+        """ Constructor. Must be called before the processes are started """
+
+        self._token = context.Array('c', _SHARED_TOKEN_MAX_SIZE)    # Its lock guards the expiration timestamp as well
+        self._expiration_timestamp = context.Value('d', 0.0, lock=False)
+
+
+    def publish(self, token: str, expiration_timestamp: float) -> None:
+        """Replace the shared token"""
+
+        with self._token.get_lock():
+            self._token.value = token.encode('utf-8')
+            self._expiration_timestamp.value = expiration_timestamp
+
+
+    def read(self) -> tuple[str, float]:
+        """Get the shared token and its expiration timestamp"""
+
+        with self._token.get_lock():
+            return self._token.value.decode('utf-8'), self._expiration_timestamp.value
+
+
+class SharedTokenReader:
+    """Provides a worker process with the access token kept fresh by the token keeper process"""
+
+    def __init__(self, shared_token: SharedToken) -> None:
+        """ Constructor """
+
+        self._shared_token = shared_token
+
+
+    def is_expired(self) -> bool:
+        """Check if the token expired, taking into account the protection interval. Returns True if the token is expired"""
+
+        _, expiration_timestamp = self._shared_token.read()
+        return time.time() > expiration_timestamp - app.token_expiration_time_delta
+
+
+    async def get_token(self) -> str:
+        """Get a valid token, waiting for the token keeper to refresh it if needed. Returns the last known token on timeout"""
+
+        deadline = time.time() + app.cli_args.http_timeout
+        while self.is_expired() and time.time() < deadline:
+            await asyncio.sleep(_SHARED_TOKEN_POLL_INTERVAL)
+        token, _ = self._shared_token.read()
+        return token
+
+
+    def start(self) -> None:
+        """Nothing to start: the token keeper process refreshes the token"""
+
+
+    async def stop(self) -> None:
+        """Nothing to stop: the token keeper process refreshes the token"""
+
+
+class TokenBucket:
+    """Limits the request rate, letting short bursts through. A zero rate means no limit"""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        """ Constructor """
+
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens: float = self._burst
+        self._updated_at = time.monotonic()
+
+
+    def get_wait_time(self) -> float:
+        """Get how long the next request would wait for the limit, in seconds"""
+
+        if not self._rate:
+            return 0.0
+        self._refill()
+        return max(0.0, (1.0 - self._tokens) / self._rate)
+
+
+    async def acquire(self) -> None:
+        """Wait until the limit lets a request through. The waiters are let through in the order they came"""
+
+        if not self._rate:
+            return
+        self._refill()
+        self._tokens -= 1.0     # Reserve a token in advance; a negative balance is the queue of the waiters
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+    def _refill(self) -> None:
+        """Add the tokens accumulated since the last update"""
+
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+class Credential:
+    """An authorization key of a SaluteSpeech account, with its own access token and request rate limit"""
+
+    def __init__(self, number: int, token_manager: TokenManager | SharedTokenReader) -> None:
+        """ Constructor """
+
+        self.number = number    # To tell the keys apart in the logs and the stats, not exposing them
+        self.token_manager = token_manager
+        self.bucket = TokenBucket(app.cli_args.key_rate, app.cli_args.key_burst)
+        self.in_flight: int = 0
+        self.ejected_until: float = 0.0
+        self.requests: int = 0
+        self.ejections: int = 0
+
+
+    def is_ejected(self) -> bool:
+        """Check if the key is taken out of use after a quota error"""
+
+        return time.time() < self.ejected_until
+
+
+    def eject(self, status: int) -> None:
+        """Take the key out of use for a while"""
+
+        if not self.is_ejected():
+            self.ejections += 1
+            app.LOGGER.warning("The authorization key #%s hit the account quota (status code %s); not using it for %s seconds.", self.number, status, app.cli_args.key_ejection_time)
+        self.ejected_until = time.time() + app.cli_args.key_ejection_time
+
+
+class CredentialPool:
+    """Spreads the cloud requests over the authorization keys of several accounts, to raise the request rate ceiling of one.
+    A request gets the least loaded key, and the keys hitting their quota are ejected for a while"""
+
+    def __init__(self, credentials: list[Credential]) -> None:
+        """ Constructor """
+
+        self._credentials = credentials
+
+
+    def select(self) -> Credential:
+        """Get the key a request would wait for the least, preferring the keys with fewer requests in progress.
+        If all the keys are ejected, gets the one returning to use first"""
+
+        available = [credential for credential in self._credentials if not credential.is_ejected()]
+        if not available:
+            return min(self._credentials, key=lambda credential: credential.ejected_until)
+        return min(available, key=lambda credential: (credential.bucket.get_wait_time(), credential.in_flight))
+
+
+    @asynccontextmanager
+    async def lease(self, credential: Credential | None = None) -> AsyncIterator[Credential]:
+        """Hold a key for a request, waiting for its rate limit. A request may need a specific key, like to poll a task it created"""
+
+        if credential is None:
+            credential = self.select()
+        credential.in_flight += 1
+        try:
+            await credential.bucket.acquire()
+            credential.requests += 1
+            yield credential
+        finally:
+            credential.in_flight -= 1
+
+
+    def record(self, credential: Credential, status: int) -> None:
+        """Account the response status, ejecting the key on a quota error"""
+
+        if status in _QUOTA_STATUSES:
+            credential.eject(status)
+
+
+    def start(self) -> None:
+        """Start refreshing the tokens in the background"""
+
+        for credential in self._credentials:
+            credential.token_manager.start()
+
+
+    async def stop(self) -> None:
+        """Stop refreshing the tokens in the background"""
+
+        for credential in self._credentials:
+            await credential.token_manager.stop()
+
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the counters of all the keys"""
+
+        stats = {}
+        for credential in self._credentials:
+            stats.update({
+                f'key{credential.number}_requests': credential.requests,
+                f'key{credential.number}_in_flight': credential.in_flight,
+                f'key{credential.number}_ejections': credential.ejections,
+                f'key{credential.number}_ejected': int( credential.is_ejected() ),
+            })
+        return stats
+
+
+def get_auth_keys() -> list[str]:
+    """Get the configured authorization keys"""
+
+    return app.cli_args.auth_key or ['']
+
+
+def create_credential_pool(shared_tokens: list[SharedToken] | None = None) -> CredentialPool:
+    """Create the pool of the configured keys. A worker process reads the tokens the token keeper shares"""
+
+    if shared_tokens is None:
+        token_managers = [TokenManager(auth_key) for auth_key in get_auth_keys()]
+    else:
+        token_managers = [SharedTokenReader(shared_token) for shared_token in shared_tokens]
+    return CredentialPool([Credential(number, token_manager) for number, token_manager in enumerate(token_managers)])
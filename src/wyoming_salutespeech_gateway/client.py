@@ -1,127 +1,254 @@
 __package__ = 'wyoming_salutespeech_gateway'
 
+import asyncio
+import json
+import logging
+import random
+import ssl
+import time
 import certifi
-import requests
+import aiohttp
+from types import SimpleNamespace
+from typing import AsyncIterator
 from uuid import uuid4
-from . import app, ca_cert
+from . import app, auth, ca_cert, encoder, scheduler, metrics, resilience, trace
+
+
+_ssl_context: ssl.SSLContext   # Shared by the pooled connections
+_ASYNC_AUDIO_ENCODINGS: dict[str, str] = {     # Upload content type -> audio encoding of an asynchronous recognition task
+	encoder.PCM_CONTENT_TYPE: 'PCM_S16LE',
+	'audio/flac': 'FLAC',
+	'audio/ogg;codecs=opus': 'OPUS',
+}
+_ASYNC_EXPECTED_REAL_TIME_FACTOR: float = 0.1  # The first task status poll is timed for the audio recognized this fast
+_ASYNC_POLL_MIN_INTERVAL: float = 0.5  # In seconds
+_ASYNC_POLL_MAX_INTERVAL: float = 5.0  # In seconds
+_ASYNC_POLL_BACKOFF: float = 1.5       # Polls of a task taking longer than expected grow less frequent
+
+
+class _AsyncRecognitionError(Exception):
+	"""The asynchronous recognition service rejected a request or failed the task"""
 
 
 # region =============================================== Subroutines
 
-def _get_auth_token() -> str:
-	"""Get authentication token"""
-
-	# Check if the token expired
-	if not app.check_if_token_expired():
-		app.LOGGER.debug(f"Access token is still valid, using the stored one.")
-		app.LOGGER.debug(f"The stored token expiration time: {app.get_time_from_timestamp(app.token_expiration_timestamp)}")
-		return app.token
-
-	# If the token is expired proceed to get a new one
-	app.LOGGER.debug(f"Access token is expired, getting a new one.")
-	app.LOGGER.debug(f"The expired token expiration time: {app.get_time_from_timestamp(app.token_expiration_timestamp)}")
-	url = app.cli_args.sber_auth_url
-	payload = 'scope=SALUTE_SPEECH_PERS'
-	headers = {
-	  'Content-Type': 'application/x-www-form-urlencoded',
-	  'Accept': 'application/json',
-	  'RqUID': str( uuid4() ),
-	  'Authorization': f'Basic {app.cli_args.auth_key}'
+async def _request(method: str, url: str, kind: str, priority: int, credential: auth.Credential | None = None, **kwargs) -> tuple[int, bytes]:
+	"""Make a request using the pooled HTTP session once the scheduler admits it, authorized with the least loaded key
+	unless a specific key is required. Returns the response status code and body"""
+
+	queue_start_time = time.monotonic()
+	async with app.request_scheduler.slot(kind, priority):
+		trace.add_span('queue', queue_start_time, time.monotonic(), kind=kind)
+		async with app.credential_pool.lease(credential) as credential:
+			with trace.span('token', key=credential.number):
+				headers = {
+					**kwargs.pop('headers', {}),
+					'Authorization': f'Bearer {await credential.token_manager.get_token()}'
+				}
+			app.LOGGER.debug("Sending a '%s' request to %s with the X-Request-ID %s.", kind, url, headers.get('X-Request-ID'))
+			async with app.client_http_session.request(method, url, headers=headers, trace_request_ctx=SimpleNamespace(kind=kind), **kwargs) as response:
+				app.credential_pool.record(credential, response.status)
+				with trace.span('download', request_id=headers.get('X-Request-ID')):
+					return response.status, await response.read()
+
+
+async def _recognize(data: bytes | memoryview | AsyncIterator[bytes], language: str, content_type: str = encoder.PCM_CONTENT_TYPE, timeout: float | None = None) -> str:
+	"""Send the audio to the recognition service. Returns the recognized text, or an empty string on failure.
+	A stream of audio chunks is not retried, as it may be uploaded only once"""
+
+	url = app.cli_args.salutespeech_url + app.recognize_api_resource
+	params = {
+		'language': language,
+		'model': app.cli_args.salutespeech_model,
+		'sample_rate': 16000
 	}
-	response = app.client_http_session.request("POST", url, headers=headers, data=payload)
-
-	if response.status_code == 200:
-		app.token = response.json().get('access_token')
-		app.token_expiration_timestamp = float( response.json().get('expires_at') ) / 1000 # Sber cloud sends the epoch timestamp in milliseconds
-		app.LOGGER.debug(f'Access token is successfully received.')
-		app.LOGGER.debug(f"The new token expiration time: {app.get_time_from_timestamp(app.token_expiration_timestamp)}")
-		return app.token
+
+	async def attempt() -> tuple[int, bytes]:
+		headers = {
+			'Content-Type': content_type,
+		  	'Accept': 'application/json',
+		  	'X-Request-ID': str( uuid4() )
+		}
+		return await _request('POST', url, 'stt', scheduler.PRIORITY_INTERACTIVE, headers=headers, params=params, data=data)
+
+	try:
+		status, body = await resilience.call('stt', attempt, timeout, retryable=isinstance(data, (bytes, memoryview)))
+	except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.SchedulerBusyError, resilience.CircuitOpenError) as err:
+		app.LOGGER.debug("Failed to recognize audio: %s: %s.", type(err).__name__, err)
+		return ''
+	if app.LOGGER.isEnabledFor(logging.DEBUG):    # Not to decode the body for nothing
+		app.LOGGER.debug("Response body: %s.", body.decode(errors='replace'))
+
+	if status == 200:
+		app.LOGGER.debug("Audio is accepted and the result is sent back.")
+		with trace.span('parse'):
+			return json.loads(body).get('result')[0]
 	else:
-		app.LOGGER.debug(f"Failed to get an access token: response status code: {response.status_code}, response text: '{response.text}'.")
+		app.LOGGER.debug("Failed to recognize audio: response status code: %s, response text: '%s'.", status, body.decode(errors='replace'))
 		return ''
 
 
+async def _call_async_api(method: str, resource: str, credential: auth.Credential, hedged: bool = True, **kwargs) -> dict | list:
+	"""Make a request to the asynchronous recognition API. Returns the decoded JSON response.
+	The files and tasks belong to an account, so all the requests of a recognition use the same key.
+	The requests have their own resilience policies: the fast polls must not affect the hedging delay and the circuit breaker of the recognitions"""
+
+	url = app.cli_args.salutespeech_url + resource
+	extra_headers = kwargs.pop('headers', {})
+
+	async def attempt() -> tuple[int, bytes]:
+		headers = {
+			'X-Request-ID': str( uuid4() ),
+			**extra_headers
+		}
+		return await _request(method, url, 'stt', scheduler.PRIORITY_INTERACTIVE, credential, headers=headers, **kwargs)
+
+	status, body = await resilience.call('stt_async', attempt, None, hedged=hedged)    # The caller sets the deadline of the whole recognition
+	if status != 200:
+		raise _AsyncRecognitionError(f"response status code: {status}, response text: '{body.decode(errors='replace')}'")
+	return json.loads(body)
+
+
+async def _recognize_async(data: bytes | memoryview, language: str, content_type: str, audio_duration: float, timeout: float) -> str:
+	"""Recognize long audio with the asynchronous API: upload it, create a recognition task, poll the task and download the result.
+	Returns the recognized text, or an empty string on failure"""
+
+	credential = app.credential_pool.select()
+	try:
+		async with asyncio.timeout(timeout):
+			upload = await _call_async_api('POST', app.upload_api_resource, credential, hedged=False, headers={'Content-Type': content_type}, data=data)
+			options = {
+				'audio_encoding': _ASYNC_AUDIO_ENCODINGS[content_type],
+				'sample_rate': 16000,
+				'channels_count': 1,
+				'language': language,
+				'model': app.cli_args.salutespeech_model,
+			}
+			task = await _call_async_api('POST', app.async_recognize_api_resource, credential, hedged=False, json={'options': options, 'request_file_id': upload['result']['request_file_id']})
+			app.LOGGER.debug("The asynchronous recognition task %s is created.", task['result']['id'])
+
+			# Many tasks are polled concurrently on the event loop; the jitter keeps their polls from coming in waves
+			interval = min(_ASYNC_POLL_MAX_INTERVAL, max(_ASYNC_POLL_MIN_INTERVAL, audio_duration * _ASYNC_EXPECTED_REAL_TIME_FACTOR))
+			while task['result']['status'] in ('NEW', 'RUNNING'):
+				await asyncio.sleep( interval * random.uniform(0.8, 1.2) )
+				interval = min(_ASYNC_POLL_MAX_INTERVAL, interval * _ASYNC_POLL_BACKOFF)
+				task = await _call_async_api('GET', app.task_api_resource, credential, params={'id': task['result']['id']})
+			if task['result']['status'] != 'DONE':
+				raise _AsyncRecognitionError(f"the task status is '{task['result']['status']}'")
+
+			results = await _call_async_api('GET', app.download_api_resource, credential, params={'response_file_id': task['result']['response_file_id']})
+	except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.SchedulerBusyError, resilience.CircuitOpenError, _AsyncRecognitionError, KeyError, ValueError) as err:
+		app.LOGGER.debug("Failed to recognize audio asynchronously: %s: %s.", type(err).__name__, err)
+		return ''
+
+	app.LOGGER.debug("Audio is recognized asynchronously and the result is downloaded.")
+	return ' '.join(
+		utterance['results'][0].get('normalized_text') or utterance['results'][0].get('text', '')
+		for utterance in results if utterance.get('results')
+	)
+
+
 # endregion
 # region =============================================== Interface
 
-def setup_ca_cert() -> None:
-	"""Place custom CA certificate in the app's certificate store"""
+async def open_http_session() -> None:
+	"""Create the app's pooled keep-alive HTTP session. Must be called within the event loop"""
 
-	try:
-		app.LOGGER.debug('Checking SSL connection to the SberSpeech service.')
-		app.client_http_session.get(app.cli_args.sber_auth_url)
-		app.LOGGER.debug('SSL connection OK, required CA certificate exists in the Certifi store.')
-		return
-	except requests.exceptions.SSLError:
-		app.LOGGER.debug('SSL error; it seems there is no required CA certificate in the Certifi store. Adding one.')
-		with open(certifi.where(), 'ab') as certifi_ca_store:
-			certifi_ca_store.write(b'\n')
-			certifi_ca_store.write( ca_cert.get() )
-		app.client_http_session.verify = certifi.where() # Make subsequent requests with the app's session use the new CA config
-	try:
-		app.LOGGER.debug('Retrying SSL connection to the SberSpeech service.')
-		app.client_http_session.get( app.cli_args.sber_auth_url)
-		app.LOGGER.debug('SSL connection OK, required CA certificate successfully added to the Certifi store.')
-	except requests.exceptions.SSLError as err:
-		app.LOGGER.debug('SSL error; failed to add CA certificate to the Certifi store.')
-		raise err
-	return
+	global _ssl_context
+	_ssl_context = ssl.create_default_context(cafile=certifi.where())
+	_ssl_context.load_verify_locations( cadata=ca_cert.get().decode('ascii') )  # The Russian CA is trusted by the app only; the Certifi store is not changed
+	connector = aiohttp.TCPConnector(
+		limit=app.cli_args.http_pool_size,
+		keepalive_timeout=app.cli_args.http_keepalive_timeout,
+		ssl=_ssl_context
+	)
+	timeout = aiohttp.ClientTimeout(total=app.cli_args.http_timeout, connect=app.cli_args.http_connect_timeout)
+	app.client_http_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[metrics.create_trace_config()])
+	app.LOGGER.debug("HTTP session is opened with the connection pool size %s.", app.cli_args.http_pool_size)
 
 
-def recognize(audio: bytes, language: str) -> str:
-	"""Recognize the speech"""
+async def close_http_session() -> None:
+	"""Close the app's HTTP session and its pooled connections"""
 
-	if app.cli_args.keep_audio_files:
-		app.write_wav(prefix='to_be_recognized_', audio=audio, framerate=16000)
+	await app.client_http_session.close()
+	app.LOGGER.debug("HTTP session is closed.")
 
-	url = app.cli_args.salutespeech_url + app.recognize_api_resource
-	headers = {
-		'Content-Type': 'audio/x-pcm;bit=16;rate=16000',
-	  	'Accept': 'application/json',
-	  	'X-Request-ID': str( uuid4() ),
-		'Authorization': f'Bearer {_get_auth_token()}'
-	}
-	params = {
-		'language': language,
-		'model': app.cli_args.salutespeech_model,
-		'sample_rate': 16000
-	}
-	response = app.client_http_session.request("POST", url, headers=headers, params=params, data=audio)
-	app.LOGGER.debug(f"Response JSON: {str(response.json())}.")
 
-	if response.status_code == 200:
-		app.LOGGER.debug("Audio is accepted and the result is sent back.")
-		return response.json().get('result')[0]
-	else:
-		app.LOGGER.debug(f"Failed to recognize audio: response status code: {response.status_code}, response text: '{response.text}'.")
+async def recognize(audio: bytes | memoryview, language: str) -> str:
+	"""Recognize the speech"""
+
+	if app.audio_archive:
+		app.audio_archive.submit(prefix='to_be_recognized_', audio=audio, framerate=16000)
+	audio_duration = len(audio) / 32000     # 16 kHz 16 bit mono
+	timeout = resilience.get_deadline(app.cli_args.request_deadline, audio_duration, app.cli_args.stt_deadline_per_second)
+	with trace.span('encode', codec=app.cli_args.upload_codec):
+		data, content_type = await encoder.encode_for_upload(audio)
+	if app.cli_args.async_recognition_threshold and audio_duration > app.cli_args.async_recognition_threshold:
+		app.LOGGER.debug("The utterance of %.1f seconds is recognized asynchronously.", audio_duration)
+		return await _recognize_async(data, language, content_type, audio_duration, timeout)
+	return await _recognize(data, language, content_type, timeout)
+
+
+async def recognize_stream(audio_chunks: AsyncIterator[bytes], language: str) -> str:
+	"""Recognize the speech, uploading the audio chunks as they arrive using the chunked transfer encoding.
+	The utterance length is unknown until the stream ends, so the deadline is set then"""
+
+	async def read_audio_chunks() -> AsyncIterator[bytes]:
+		received_chunks = []
+		audio_size = 0
+		async for audio_chunk in audio_chunks:
+			audio_size += len(audio_chunk)
+			if app.audio_archive:
+				received_chunks.append(audio_chunk)
+			yield audio_chunk
+		if app.audio_archive:
+			app.audio_archive.submit(prefix='to_be_recognized_', audio=b"".join(received_chunks), framerate=16000)
+		nonlocal timeout
+		timeout = resilience.get_deadline(app.cli_args.request_deadline, audio_size / 32000, app.cli_args.stt_deadline_per_second)	# 16 kHz 16 bit mono
+		deadline.reschedule(asyncio.get_running_loop().time() + timeout)
+
+	timeout = None
+	try:
+		async with asyncio.timeout(None) as deadline:
+			return await _recognize(read_audio_chunks(), language)
+	except TimeoutError:
+		app.LOGGER.warning("The streamed 'stt' request is not completed within the deadline of %.1f seconds after the audio end.", timeout)
 		return ''
 
 
-def synthesize(text: str, language: str, voice: str) -> bytes:
-	""" Synthesize the speech """
+async def synthesize(text: str, language: str, voice: str, priority: int = scheduler.PRIORITY_NORMAL, rate: int = 24000) -> bytes:
+	""" Synthesize the speech. The rate must match the voice variant, like 8000 for 'Ost_8000' """
 
 	url = app.cli_args.salutespeech_url + app.synthesize_api_resource
-	headers = {
-		'Content-Type': 'application/text',
-	  	'Accept': 'audio/x-pcm;bit=16;rate=24000',
-	  	'X-Request-ID': str( uuid4() ),
-		'Authorization': f'Bearer {_get_auth_token()}'
-	}
 	params = {
 		'language': language,
 		'format': "pcm16",
 		'voice': voice
 	}
-	response = app.client_http_session.request("POST", url, headers=headers, params=params, data=text)
 
-	if response.status_code == 200:
+	async def attempt() -> tuple[int, bytes]:
+		headers = {
+			'Content-Type': 'application/text',
+		  	'Accept': f'audio/x-pcm;bit=16;rate={rate}',
+		  	'X-Request-ID': str( uuid4() )
+		}
+		return await _request('POST', url, 'tts', priority, headers=headers, params=params, data=text.encode('utf-8'))
+
+	timeout = resilience.get_deadline(app.cli_args.request_deadline, len(text), app.cli_args.tts_deadline_per_char)
+	try:
+		status, body = await resilience.call('tts', attempt, timeout)
+	except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.SchedulerBusyError, resilience.CircuitOpenError) as err:
+		app.LOGGER.debug("Failed to synthesize audio: %s: %s.", type(err).__name__, err)
+		return b""
+
+	if status == 200:
 		app.LOGGER.debug("The text is accepted and a result is received.")
-		if app.cli_args.keep_audio_files:
-			app.write_wav(prefix='synthesized_', audio=response.content, framerate=24000)
-		return response.content
+		if app.audio_archive:
+			app.audio_archive.submit(prefix='synthesized_', audio=body, framerate=rate)
+		return body
 	else:
 		app.LOGGER.debug(
-			f"Failed to synthesize audio: response status code: {response.status_code}, response text: '{response.text}'.")
+			"Failed to synthesize audio: response status code: %s, response text: '%s'.", status, body.decode(errors='replace'))
 		return b""
 
 
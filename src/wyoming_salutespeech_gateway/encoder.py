@@ -0,0 +1,56 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import io
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:     # An optional dependency; the audio is uploaded as PCM without it
+    soundfile = None
+
+from . import app
+
+
+PCM_CONTENT_TYPE: str = 'audio/x-pcm;bit=16;rate=16000'
+_CONTENT_TYPES: dict[str, str] = {
+    'flac': 'audio/flac',
+    'opus': 'audio/ogg;codecs=opus',
+}
+_SOUNDFILE_FORMATS: dict[str, tuple[str, str]] = {     # Codec -> (container format, subtype)
+    'flac': ('FLAC', 'PCM_16'),
+    'opus': ('OGG', 'OPUS'),
+}
+
+
+# region =============================================== Interface
+
+def encode(audio: bytes | memoryview, codec: str) -> tuple[bytes | memoryview, str]:
+    """Compress 16 kHz 16-bit mono PCM audio. Returns the data and its content type; falls back to PCM on failure. Blocking"""
+
+    if codec == 'pcm' or not audio:
+        return audio, PCM_CONTENT_TYPE
+    if soundfile is None:
+        app.LOGGER.debug("The 'soundfile' package is not installed; uploading PCM instead of '%s'.", codec)
+        return audio, PCM_CONTENT_TYPE
+    container_format, subtype = _SOUNDFILE_FORMATS[codec]
+    encoded_audio = io.BytesIO()
+    try:
+        soundfile.write(encoded_audio, np.frombuffer(audio, dtype='<i2'), 16000, format=container_format, subtype=subtype)
+    except (RuntimeError, TypeError, ValueError) as err:     # libsndfile errors are RuntimeError subclasses
+        app.LOGGER.debug("Failed to encode audio to '%s', uploading PCM instead: %s.", codec, err)
+        return audio, PCM_CONTENT_TYPE
+    app.LOGGER.debug("Audio is encoded to '%s': %s -> %s bytes.", codec, len(audio), encoded_audio.tell())
+    return encoded_audio.getbuffer(), _CONTENT_TYPES[codec]
+
+
+async def encode_for_upload(audio: bytes | memoryview) -> tuple[bytes | memoryview, str]:
+    """Compress the audio with the configured codec off the event loop"""
+
+    if app.cli_args.upload_codec == 'pcm':
+        return audio, PCM_CONTENT_TYPE
+    return await asyncio.to_thread(encode, audio, app.cli_args.upload_codec)
+
+
+# endregion
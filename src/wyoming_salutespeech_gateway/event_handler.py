@@ -1,6 +1,7 @@
 __package__ = 'wyoming_salutespeech_gateway'
 
 import time
+from contextlib import aclosing
 
 from wyoming.asr import Transcribe, Transcript
 from wyoming.audio import AudioChunk, AudioChunkConverter, AudioStart, AudioStop
@@ -9,7 +10,7 @@ from wyoming.info import Describe
 from wyoming.server import AsyncEventHandler
 from wyoming.tts import Synthesize
 
-from . import app, server, client
+from . import app, server, client, tts_stream, stt_stream, stt_speculation, vad, metrics, audio_writer, audio_format, trace
 
 
 class GatewayEventHandler(AsyncEventHandler):
@@ -26,15 +27,31 @@ class GatewayEventHandler(AsyncEventHandler):
 
         self._language = app.cli_args.language
         self._voice = app.cli_args.salutespeech_voice
-        self._audio = b""
+        self._audio = bytearray()   # Grows in place, unlike bytes which are copied on every concatenation
+        self._audio_size = 0        # Counts the streamed audio as well
+        self._max_audio_size = int(app.cli_args.max_utterance_duration * 16000) * 2
+        self._audio_truncated = False
+        self._utterance_ended = False   # The end of speech is detected before the 'AudioStop' event
+        self._recognition_stream: stt_stream.RecognitionStream | None = None
+        self._vad = vad.VoiceActivityDetector() if app.cli_args.vad or app.cli_args.stt_speculation else None   # The speculation needs speech pauses
+        self._speculator: stt_speculation.SpeculativeRecognizer | None = None
         self._audio_converter = AudioChunkConverter(rate=16000, width=2, channels=1)
+        self._audio_start_time = 0.0
+        self._synthesizing = False
+        self._session_id = trace.new_id()
+        self._trace: trace.Trace | None = None      # Of the utterance being received
+        peer = self.writer.get_extra_info('peername')
+        self._output_format = audio_format.get_client_format(peer[0] if isinstance(peer, tuple) else None)   # Unix socket clients have no address
+        self._audio_writer = audio_writer.AudioWriter(self.writer, *self._output_format)
+        metrics.active_connections.inc()
 
 
     async def handle_event(self, event: Event) -> bool:
         """Handle the event"""
 
         if Describe.is_type(event.type):
-            await self.write_event( server.get_wyoming_info().event() )
+            self.writer.write( server.get_wyoming_info_event() )
+            await self.writer.drain()
             app.LOGGER.debug("Processed a 'Describe' event: Wyoming info is sent to the client.")
             return True
 
@@ -42,29 +59,53 @@ class GatewayEventHandler(AsyncEventHandler):
             transcribe = Transcribe.from_event(event)
             if transcribe.language:
                 self._language = transcribe.language
-                app.LOGGER.debug(f"Processed a 'Transcribe' event: the language is set to '{transcribe.language}'.")
+                app.LOGGER.debug("Processed a 'Transcribe' event: the language is set to '%s'.", transcribe.language)
             return True
 
         if AudioChunk.is_type(event.type):
-            if not self._audio:
+            if self._utterance_ended:
+                return True
+            if not self._audio_size:
                 app.LOGGER.debug("Processing an 'AudioChunk' event: starting to receive audio chunks.")
+                self._audio_start_time = time.time()
+                self._trace = trace.begin('stt', self._session_id)
+                self._trace.attributes['language'] = self._language
             chunk = AudioChunk.from_event(event)
+            metrics.audio_received_bytes.inc( len(chunk.audio) )
+            convert_start_time = time.monotonic()
             chunk = self._audio_converter.convert(chunk)
-            self._audio += chunk.audio
+            self._trace.accumulate('convert', convert_start_time, time.monotonic())
+            if self._audio_size + len(chunk.audio) > self._max_audio_size:
+                if not self._audio_truncated:
+                    app.LOGGER.warning("Processing an 'AudioChunk' event: the utterance exceeds %s seconds, the rest of it is dropped.", app.cli_args.max_utterance_duration)
+                    self._audio_truncated = True
+                return True
+            self._audio_size += len(chunk.audio)
+            if self._vad:
+                vad_start_time = time.monotonic()
+                self._vad.process(chunk.audio)
+                self._trace.accumulate('vad', vad_start_time, time.monotonic())
+            if app.cli_args.stt_streaming:
+                if not self._recognition_stream:
+                    app.LOGGER.debug("Processing an 'AudioChunk' event: starting a streaming transcription.")
+                    self._recognition_stream = stt_stream.RecognitionStream(self._language)
+                self._recognition_stream.feed(chunk.audio)
+            else:
+                self._audio.extend(chunk.audio)
+                if app.cli_args.stt_speculation:
+                    if not self._speculator:
+                        self._speculator = stt_speculation.SpeculativeRecognizer(self._language, self._vad)
+                    self._speculator.update(self._audio)
+            if app.cli_args.vad and self._vad.is_speech_ended():
+                app.LOGGER.debug("Processing an 'AudioChunk' event: the end of speech is detected, not waiting for the 'AudioStop' event.")
+                await self._transcribe()
+                self._utterance_ended = True
             return True
 
         if AudioStop.is_type(event.type):
-            start_time = time.time()
-            app.LOGGER.debug("Processing an 'AudioStop' event: starting a transcription.")
-            text = client.recognize(self._audio, self._language)
-            app.LOGGER.info(f"Processing an 'AudioStop' event: the transcription is completed in {time.time() - start_time:.2f} seconds.")
-
-            await self.write_event( Transcript(text=text).event() )
-            app.LOGGER.debug("Processed an 'AudioStop' event: the recognized text is sent to a Wyoming client.")
-
-            # Clean up
-            self._audio = b""
-            self._language = app.cli_args.language
+            if not self._utterance_ended:
+                await self._transcribe()
+            self._utterance_ended = False
 
         if Synthesize.is_type(event.type):
             synthesize = Synthesize.from_event(event)
@@ -73,23 +114,40 @@ class GatewayEventHandler(AsyncEventHandler):
                 app.LOGGER.debug("Processing a 'Synthesize' event: the event conveys a 'voice' object.")
                 self._voice = synthesize.voice.name if synthesize.voice.name else app.cli_args.salutespeech_voice
                 self._language = synthesize.voice.language if synthesize.voice.language else app.cli_args.language
-                app.LOGGER.debug(f"Processing a 'Synthesize' event: the voice is set to '{self._voice}'.")
-                app.LOGGER.debug(f"Processing a 'Synthesize' event: the language is set to '{self._language}'.")
+                app.LOGGER.debug("Processing a 'Synthesize' event: the voice is set to '%s'.", self._voice)
+                app.LOGGER.debug("Processing a 'Synthesize' event: the language is set to '%s'.", self._language)
             start_time = time.time()
-            app.LOGGER.debug(f"Processing a 'Synthesize' event: starting to synthesize the text '{text}'.")
-            audio = client.synthesize(text=text, language=self._language, voice=self._voice)
-            app.LOGGER.info(f"Processing a 'Synthesize' event: the synthesis is completed in {time.time() - start_time:.2f} seconds.")
-            chunks = server.split_audio_into_chunks(audio)
-
-            # Send the result to a Wyoming client
-            await self.write_event(
-                AudioStart(rate=24000, width=2, channels=1).event(),
-            )
-            for chunk in chunks:
+            app.LOGGER.debug("Processing a 'Synthesize' event: starting to synthesize the text '%s'.", text)
+            synthesis_trace = trace.begin('tts', self._session_id)
+            synthesis_trace.attributes.update(language=self._language, voice=self._voice, text_length=len(text))
+
+            # Send the result to a Wyoming client as soon as each audio segment is ready
+            self._synthesizing = True
+            try:
                 await self.write_event(
-                    AudioChunk(audio=chunk, rate=24000, width=2, channels=1).event(),
+                    AudioStart(rate=self._output_format.rate, width=self._output_format.width, channels=self._output_format.channels).event(),
                 )
-            await self.write_event(AudioStop().event())
+                segments_number = 0
+                metrics_first_audio_observed = False
+                async with aclosing( tts_stream.synthesize(text=text, language=self._language, voice=self._voice, output_format=self._output_format) ) as segments:
+                    async for audio in segments:
+                        if not segments_number:
+                            synthesis_trace.attributes['first_audio_ms'] = round((time.monotonic() - synthesis_trace.start_time) * 1000, 1)
+                            app.LOGGER.info("Processing a 'Synthesize' event: the first audio segment is ready in %.2f seconds.", time.time() - start_time)
+                        segments_number += 1
+                        send_start_time = time.monotonic()
+                        await self._audio_writer.write(audio)
+                        synthesis_trace.accumulate('send', send_start_time, time.monotonic())
+                        if not metrics_first_audio_observed:
+                            metrics.tts_first_audio_seconds.observe(time.time() - start_time)
+                            metrics_first_audio_observed = True
+                await self.write_event(AudioStop().event())
+            finally:
+                self._synthesizing = False
+            metrics.synthesis_seconds.observe(time.time() - start_time)
+            synthesis_trace.attributes['segments'] = segments_number
+            trace.finish(synthesis_trace)
+            app.LOGGER.info("Processing a 'Synthesize' event: the synthesis is completed in %.2f seconds.", time.time() - start_time)
             app.LOGGER.debug("Processed a 'Synthesize' event: the synthesized audio is sent to a Wyoming client.")
 
             # Clean up
@@ -97,3 +155,66 @@ class GatewayEventHandler(AsyncEventHandler):
             self._language = app.cli_args.language
 
         return True
+
+
+    def is_busy(self) -> bool:
+        """Check if a request of the client is in progress, like an utterance being received or a text being synthesized"""
+
+        return bool(self._audio_size) or self._synthesizing
+
+
+    async def disconnect(self) -> None:
+        """Abandon an unfinished transcription when the client disconnects"""
+
+        metrics.active_connections.dec()
+        if self._recognition_stream:
+            self._recognition_stream.cancel()
+        if self._speculator:
+            self._speculator.cancel()
+
+
+    async def _transcribe(self) -> None:
+        """Recognize the received utterance and send the text to a Wyoming client"""
+
+        start_time = time.time()
+        if self._audio_size:
+            metrics.audio_receive_seconds.observe(start_time - self._audio_start_time)
+        if self._trace:
+            self._trace.add_span('receive', self._trace.start_time, time.monotonic())     # From the first audio chunk
+        if self._recognition_stream:
+            app.LOGGER.debug("Processing an utterance: completing the streaming transcription.")
+            text = await self._recognition_stream.finish()
+        else:
+            text = await self._speculator.finish() if self._speculator else None
+            if text is not None:
+                app.LOGGER.debug("Processing an utterance: the speculative transcription covers all the speech.")
+            else:
+                audio = memoryview(self._audio)     # Passed to the HTTP layer without copying
+                if app.cli_args.vad:
+                    with trace.span('trim'):
+                        audio = self._vad.trim(audio)
+                if audio:
+                    app.LOGGER.debug("Processing an utterance: starting a transcription.")
+                    text = await client.recognize(audio, self._language)
+                else:
+                    app.LOGGER.debug("Processing an utterance: no speech is detected, skipping the transcription.")
+                    text = ''
+        metrics.transcription_seconds.observe(time.time() - start_time)
+        app.LOGGER.info("Processing an utterance: the transcription is completed in %.2f seconds.", time.time() - start_time)
+
+        with trace.span('send'):
+            await self.write_event( Transcript(text=text).event() )
+        app.LOGGER.debug("Processed an utterance: the recognized text is sent to a Wyoming client.")
+        if self._trace:
+            self._trace.attributes.update(audio_bytes=self._audio_size, text_length=len(text), streaming=bool(self._recognition_stream), speculative=bool(self._speculator))
+            trace.finish(self._trace)
+
+        # Clean up
+        self._audio = bytearray()   # Not cleared in place: the exported memoryview may still be referenced
+        self._audio_size = 0
+        self._audio_truncated = False
+        self._trace = None
+        self._recognition_stream = None
+        self._speculator = None
+        self._vad = vad.VoiceActivityDetector() if app.cli_args.vad or app.cli_args.stt_speculation else None
+        self._language = app.cli_args.language
@@ -0,0 +1,222 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import math
+from typing import Callable
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+
+from . import app, trace
+
+
+_PREFIX: str = 'salutespeech_gateway_'
+_DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+_registry: list['_Metric'] = []
+_collectors: list[tuple[str, str, Callable[[], dict[str, int | float]]]] = []    # (name prefix, help, stats getter) of gauges read at scrape time
+
+
+# region =============================================== Metric types
+
+class _Metric:
+    """A base of a labelled metric in the Prometheus text exposition format"""
+
+    type_name: str = ''
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        """ Constructor """
+
+        self.name = _PREFIX + name
+        self._help_text = help_text
+        self._label_names = label_names
+        _registry.append(self)
+
+
+    def expose(self) -> list[str]:
+        """Get the metric lines"""
+
+        return [f"# HELP {self.name} {self._help_text}", f"# TYPE {self.name} {self.type_name}"]
+
+
+    def _format_labels(self, label_values: tuple[str, ...], extra: str = '') -> str:
+        """Format the label set like '{kind="stt",le="0.5"}'"""
+
+        labels = [f'{name}="{value}"' for name, value in zip(self._label_names, label_values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter(_Metric):
+    """A monotonically increasing value"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        """ Constructor """
+
+        super().__init__(name, help_text, label_names)
+        self._values: dict[tuple[str, ...], float] = {}
+
+
+    def inc(self, amount: float = 1.0, *label_values: str) -> None:
+        """Increase the value of the label set"""
+
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+
+    def expose(self) -> list[str]:
+        """Get the metric lines"""
+
+        return super().expose() + [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value going up and down"""
+
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1.0, *label_values: str) -> None:
+        """Decrease the value of the label set"""
+
+        self.inc(-amount, *label_values)
+
+
+class Histogram(_Metric):
+    """A distribution of observed values, like durations, over cumulative buckets"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = _DEFAULT_BUCKETS) -> None:
+        """ Constructor """
+
+        super().__init__(name, help_text, label_names)
+        self._buckets = buckets
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+
+    def observe(self, value: float, *label_values: str) -> None:
+        """Account the observed value"""
+
+        counts = self._counts.setdefault(label_values, [0] * len(self._buckets))
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._sums[label_values] = self._sums.get(label_values, 0.0) + value
+
+
+    def expose(self) -> list[str]:
+        """Get the metric lines"""
+
+        lines = super().expose()
+        for labels, counts in self._counts.items():
+            for bound, count in zip(self._buckets, counts):
+                le_label = 'le="+Inf"' if math.isinf(bound) else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(labels, le_label)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {self._sums[labels]}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+# endregion
+# region =============================================== Metrics
+
+audio_receive_seconds = Histogram('audio_receive_seconds', 'Time from the first audio chunk to the end of an utterance')
+upstream_upload_seconds = Histogram('upstream_upload_seconds', 'Time to send a request to the cloud', ('kind',))
+upstream_processing_seconds = Histogram('upstream_processing_seconds', 'Time from the request sent to the response received', ('kind',))
+token_fetch_seconds = Histogram('token_fetch_seconds', 'Time to get an access token')
+transcription_seconds = Histogram('transcription_seconds', 'Time from the end of an utterance to the transcript ready')
+synthesis_seconds = Histogram('synthesis_seconds', 'Time to synthesize and send the whole text')
+tts_first_audio_seconds = Histogram('tts_first_audio_seconds', 'Time from a synthesis request to the first audio chunk sent')
+chunk_send_seconds = Histogram('chunk_send_seconds', 'Time to send a batch of audio chunks to a Wyoming client', buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, math.inf))
+audio_received_bytes = Counter('audio_received_bytes_total', 'Audio received from Wyoming clients')
+audio_sent_bytes = Counter('audio_sent_bytes_total', 'Audio sent to Wyoming clients')
+upstream_uploaded_bytes = Counter('upstream_uploaded_bytes_total', 'Data sent to the cloud', ('kind',))
+upstream_responses = Counter('upstream_responses_total', 'Cloud responses by HTTP status; the status is "error" for transport failures', ('kind', 'status'))
+active_connections = Gauge('active_connections', 'Wyoming clients connected')
+
+
+# endregion
+# region =============================================== Interface
+
+def add_stats_collector(name_prefix: str, help_text: str, get_stats: Callable[[], dict[str, int | float]]) -> None:
+    """Expose the stats a component keeps by itself, like cache or queue counters, as gauges read at scrape time"""
+
+    _collectors.append( (name_prefix, help_text, get_stats) )
+
+
+def expose() -> str:
+    """Get all the metrics in the Prometheus text exposition format"""
+
+    lines = []
+    for metric in _registry:
+        lines.extend( metric.expose() )
+    for name_prefix, help_text, get_stats in _collectors:
+        for key, value in get_stats().items():
+            name = f"{_PREFIX}{name_prefix}_{key}"
+            lines.extend([f"# HELP {name} {help_text}: {key}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return '\n'.join(lines) + '\n'
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """Create the HTTP session hooks timing the upload and the cloud processing of each request.
+    A request passes its kind, like 'stt', in the 'trace_request_ctx' argument"""
+
+    async def on_request_start(session, context, params) -> None:
+        context.start_time = context.sent_time = asyncio.get_running_loop().time()
+
+    async def on_request_chunk_sent(session, context, params) -> None:
+        context.sent_time = asyncio.get_running_loop().time()
+        upstream_uploaded_bytes.inc(len(params.chunk), _get_kind(context))
+
+    async def on_request_end(session, context, params) -> None:
+        kind = _get_kind(context)
+        end_time = asyncio.get_running_loop().time()
+        upstream_upload_seconds.observe(context.sent_time - context.start_time, kind)
+        upstream_processing_seconds.observe(end_time - context.sent_time, kind)
+        upstream_responses.inc(1, kind, str(params.response.status))
+        request_id = params.headers.get('X-Request-ID')     # The hooks run in the task making the request, having its trace
+        trace.add_span('upload', context.start_time, context.sent_time, request_id=request_id)
+        trace.add_span('cloud', context.sent_time, end_time, request_id=request_id, status=params.response.status)
+
+    async def on_request_exception(session, context, params) -> None:
+        upstream_responses.inc(1, _get_kind(context), 'error')
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+async def start_server() -> web.AppRunner | None:
+    """Start the HTTP listener serving the metrics at '/metrics', if configured. Each worker process listens to its own port"""
+
+    if not app.cli_args.metrics_uri:
+        return None
+    uri = urlparse(app.cli_args.metrics_uri)
+    port = uri.port + app.worker_number
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=expose(), content_type='text/plain', charset='utf-8', headers={'Cache-Control': 'no-cache'})
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, uri.hostname, port).start()
+    app.LOGGER.info("Metrics are served at http://%s:%s/metrics.", uri.hostname, port)
+    return runner
+
+
+def _get_kind(context) -> str:
+    """Get the request kind passed to the session hooks"""
+
+    return getattr(context.trace_request_ctx, 'kind', None) or 'other'
+
+
+# endregion
@@ -0,0 +1,144 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import signal
+from typing import NamedTuple
+
+from . import app, tts_cache, tts_stream, scheduler, audio_format
+
+
+_IDLE_CHECK_INTERVAL: float = 1.0  # How often a waiting pre-warmer checks if the cloud requests are over, in seconds
+
+
+class Phrase(NamedTuple):
+    """A phrase to synthesize in advance"""
+
+    text: str
+    language: str
+    voice: str
+
+
+# region =============================================== Subroutines
+
+def _parse_line(line: str) -> Phrase | None:
+    """Parse a phrase file line: 'text', 'voice|text' or 'voice|language|text'. Returns None for blank and comment lines"""
+
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    fields = [field.strip() for field in line.split('|', 2)]
+    if len(fields) == 1:
+        return Phrase(fields[0], app.cli_args.language, app.cli_args.salutespeech_voice)
+    if len(fields) == 2:
+        return Phrase(fields[1], app.cli_args.language, fields[0] or app.cli_args.salutespeech_voice)
+    return Phrase(fields[2], fields[1] or app.cli_args.language, fields[0] or app.cli_args.salutespeech_voice)
+
+
+def _read_phrases(path: str) -> list[Phrase]:
+    """Read the phrase file. Blocking"""
+
+    with open(path, encoding='utf-8') as phrase_file:
+        phrases = [_parse_line(line) for line in phrase_file]
+    return [phrase for phrase in phrases if phrase is not None and phrase.text]
+
+
+def _get_output_formats() -> list[audio_format.AudioFormat]:
+    """Get the formats the clients play, so each of them finds its audio in the cache"""
+
+    output_formats = [app.cli_args.tts_output_format]
+    for _, client_format in app.cli_args.tts_client_format:
+        if client_format not in output_formats:
+            output_formats.append(client_format)
+    return output_formats
+
+
+# endregion
+# region =============================================== Interface
+
+class Prewarmer:
+    """Synthesizes the phrases of the phrase file into the TTS cache in advance, so playing them needs no cloud call.
+    Works while the gateway is idle, within the rate limit; re-reads the file on SIGHUP and periodically refills the cache"""
+
+    def __init__(self, path: str) -> None:
+        """ Constructor """
+
+        self._path = path
+        self._reload_requested = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.phrases: int = 0
+        self.synthesized: int = 0
+        self.failed: int = 0
+
+
+    def start(self) -> None:
+        """Start pre-warming in the background"""
+
+        if self._task is None:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_requested.set)
+            self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self) -> None:
+        """Stop pre-warming"""
+
+        if self._task is not None:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._task.cancel()
+            self._task = None
+
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the pre-warming counters"""
+
+        return {
+            'phrases': self.phrases,
+            'synthesized': self.synthesized,
+            'failed': self.failed,
+        }
+
+
+    async def _run(self) -> None:
+        """Pre-warm the cache on the start, on every reload and periodically, as the cached audio expires"""
+
+        while True:
+            self._reload_requested.clear()
+            try:
+                phrases = await asyncio.to_thread(_read_phrases, self._path)
+                self.phrases = len(phrases)
+                app.LOGGER.info("The pre-warm file is read: %s phrases.", len(phrases))
+                await self._warm(phrases)
+            except OSError as err:
+                app.LOGGER.error("Failed to read the pre-warm file '%s': %s.", self._path, err)
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), app.cli_args.prewarm_interval)
+                app.LOGGER.info("Reloading the pre-warm file.")
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def _warm(self, phrases: list[Phrase]) -> None:
+        """Synthesize the phrases missing in the cache, one at a time, when no other cloud request is in progress"""
+
+        synthesized = 0
+        for phrase in phrases:
+            texts = tts_stream.split_text(phrase.text) if app.cli_args.tts_streaming else [phrase.text]   # Cached as the handler requests them
+            for text in texts:
+                for output_format in _get_output_formats():
+                    if await app.tts_audio_cache.contains( tts_cache.get_key(text, phrase.language, phrase.voice, output_format) ):
+                        continue
+                    while not app.request_scheduler.is_idle():
+                        await asyncio.sleep(_IDLE_CHECK_INTERVAL)
+                    if self._reload_requested.is_set():
+                        return
+                    audio = await tts_cache.synthesize(text, phrase.language, phrase.voice, output_format, scheduler.PRIORITY_BULK)
+                    if audio:
+                        self.synthesized += 1
+                        synthesized += 1
+                    else:
+                        self.failed += 1
+                    if app.cli_args.prewarm_rate > 0:
+                        await asyncio.sleep(60.0 / app.cli_args.prewarm_rate)
+        app.LOGGER.info("The TTS cache is pre-warmed: %s missing items synthesized, %s failed in total.", synthesized, self.failed)
+
+
+# endregion
@@ -0,0 +1,261 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import aiohttp
+
+from . import app
+
+
+_RETRYABLE_STATUSES: frozenset[int] = frozenset({429, 500, 502, 503, 504})
+_RETRY_BASE_DELAY: float = 0.1     # A delay before the first retry of a failed request, in seconds
+_RETRY_MAX_DELAY: float = 1.0      # An upper bound of the exponential retry delay; a user is waiting, in seconds
+_RETRY_BUDGET_MAX_BALANCE: float = 10.0     # Retries allowed in a burst, like after a quiet period
+_LATENCY_WINDOW: int = 200         # Number of the recent successful requests the hedging delay is based on
+_LATENCY_MIN_SAMPLES: int = 20     # Do not hedge until the latency distribution is known
+
+Attempt = Callable[[], Awaitable[tuple[int, bytes]]]    # Makes one request; returns the response status code and body
+
+
+class CircuitOpenError(Exception):
+    """The request is rejected at once because the service keeps failing"""
+
+
+# region =============================================== Policies
+
+class CircuitBreaker:
+    """Fails requests fast after consecutive failures, then lets a single probe through once the timeout passes"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        """ Constructor """
+
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+
+
+    def allow(self) -> bool:
+        """Check if a request may be made. Returns False while the circuit is open"""
+
+        if self._opened_at is None:
+            return True
+        if time.time() < self._opened_at + self._reset_timeout:
+            return False
+        self._opened_at = time.time()   # Half-open: a single probe per timeout; its result closes the circuit or keeps it open
+        return True
+
+
+    def is_open(self) -> bool:
+        """Check if the requests fail fast"""
+
+        return self._opened_at is not None
+
+
+    def record(self, success: bool) -> None:
+        """Account the request result"""
+
+        if success:
+            self._failures = 0
+            self._opened_at = None
+            return
+        self._failures += 1
+        if self._failure_threshold and self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                app.LOGGER.warning("The cloud service failed %s times in a row; failing requests fast for %s seconds.", self._failures, self._reset_timeout)
+            self._opened_at = time.time()
+
+
+class RetryBudget:
+    """Limits retries and hedged requests to a share of the requests, so they do not multiply the load on a degraded service"""
+
+    def __init__(self, ratio: float) -> None:
+        """ Constructor """
+
+        self._ratio = ratio
+        self._balance = _RETRY_BUDGET_MAX_BALANCE
+
+
+    def deposit(self) -> None:
+        """Account a new request"""
+
+        self._balance = min(_RETRY_BUDGET_MAX_BALANCE, self._balance + self._ratio)
+
+
+    def withdraw(self) -> bool:
+        """Spend the budget on an extra request. Returns False if the budget is exhausted"""
+
+        if self._balance < 1.0:
+            return False
+        self._balance -= 1.0
+        return True
+
+
+class _Guard:
+    """The policies and the counters of a request kind, like 'stt'"""
+
+    def __init__(self) -> None:
+        """ Constructor """
+
+        self.breaker = CircuitBreaker(app.cli_args.circuit_breaker_threshold, app.cli_args.circuit_breaker_timeout)
+        self.budget = RetryBudget(app.cli_args.retry_budget)
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self.retries: int = 0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+        self.budget_exhausted: int = 0
+        self.fast_failures: int = 0
+        self.deadlines_exceeded: int = 0
+
+
+    def get_hedging_delay(self) -> float | None:
+        """Get the 95th percentile of the recent latencies. Returns None until there are enough samples"""
+
+        if len(self.latencies) < _LATENCY_MIN_SAMPLES:
+            return None
+        return sorted(self.latencies)[ int(len(self.latencies) * 0.95) ]
+
+
+_guards: dict[str, _Guard] = {}
+
+
+# endregion
+# region =============================================== Subroutines
+
+def _get_guard(kind: str) -> _Guard:
+    """Get the policies of the request kind"""
+
+    guard = _guards.get(kind)
+    if guard is None:
+        guard = _guards[kind] = _Guard()
+    return guard
+
+
+def _is_failure(status: int) -> bool:
+    """Check if the response status means the service failed, so the request is worth retrying"""
+
+    return status in _RETRYABLE_STATUSES
+
+
+async def _attempt(guard: _Guard, attempt: Attempt) -> tuple[int, bytes]:
+    """Make one request, accounting its result and latency"""
+
+    start_time = time.time()
+    try:
+        status, body = await attempt()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        guard.breaker.record(False)
+        raise
+    guard.breaker.record( not _is_failure(status) )
+    if status == 200:
+        guard.latencies.append(time.time() - start_time)
+    return status, body
+
+
+async def _attempt_hedged(guard: _Guard, attempt: Attempt) -> tuple[int, bytes]:
+    """Make a request, sending a second one if the first is slower than usual. The first good response wins"""
+
+    tasks = { asyncio.create_task(_attempt(guard, attempt)) }
+    hedged_task = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=guard.get_hedging_delay())
+        if not done:
+            if guard.budget.withdraw():
+                app.LOGGER.debug("The cloud service is slower than usual; sending a hedged request.")
+                guard.hedges += 1
+                hedged_task = asyncio.create_task(_attempt(guard, attempt))
+                tasks.add(hedged_task)
+            else:
+                guard.budget_exhausted += 1
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and not _is_failure( task.result()[0] ):
+                    if task is hedged_task:
+                        guard.hedge_wins += 1
+                    return task.result()
+            if not pending:
+                return done.pop().result()  # Both failed; raises the error if any
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# endregion
+# region =============================================== Interface
+
+async def call(kind: str, attempt: Attempt, timeout: float | None, retryable: bool = True, hedged: bool = True) -> tuple[int, bytes]:
+    """Make a request within the deadline, retrying and hedging it within the retry budget, unless the circuit breaker is open.
+    A request with a one-off body, like a stream, is not retryable; a request creating a resource, like a task, is not hedged.
+    Raises CircuitOpenError, asyncio.TimeoutError or the transport error"""
+
+    guard = _get_guard(kind)
+    if not guard.breaker.allow():
+        guard.fast_failures += 1
+        raise CircuitOpenError(f"The '{kind}' requests fail fast while the cloud service is failing")
+    guard.budget.deposit()
+    try:
+        async with asyncio.timeout(timeout) as deadline:
+            attempts_number = app.cli_args.retries + 1 if retryable else 1
+            last_error = None
+            for attempt_number in range(attempts_number):
+                if attempt_number:
+                    if guard.breaker.is_open():
+                        break
+                    if not guard.budget.withdraw():
+                        guard.budget_exhausted += 1
+                        break
+                    delay = random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2 ** attempt_number))  # Full jitter
+                    app.LOGGER.debug("Retrying the failed '%s' request in %.2f seconds.", kind, delay)
+                    await asyncio.sleep(delay)
+                    guard.retries += 1
+                try:
+                    if retryable and hedged and app.cli_args.hedging:
+                        status, body = await _attempt_hedged(guard, attempt)
+                    else:
+                        status, body = await _attempt(guard, attempt)
+                    last_error = None
+                    if not _is_failure(status):
+                        return status, body
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    app.LOGGER.debug("The '%s' request failed: %s: %s.", kind, type(err).__name__, err)
+                    last_error = err
+            if last_error is not None:
+                raise last_error
+            return status, body
+    except TimeoutError:
+        if deadline.expired():
+            guard.deadlines_exceeded += 1
+            app.LOGGER.warning("The '%s' request is not completed within the deadline of %.1f seconds.", kind, timeout)
+        raise
+
+
+def get_deadline(base: float, size: float, seconds_per_unit: float) -> float:
+    """Get the deadline of a request growing with its size, like the audio duration or the text length"""
+
+    return base + size * seconds_per_unit
+
+
+def get_stats() -> dict[str, int]:
+    """Get the counters of all the request kinds"""
+
+    stats = {}
+    for kind, guard in _guards.items():
+        stats.update({
+            f'{kind}_retries': guard.retries,
+            f'{kind}_hedges': guard.hedges,
+            f'{kind}_hedge_wins': guard.hedge_wins,
+            f'{kind}_budget_exhausted': guard.budget_exhausted,
+            f'{kind}_fast_failures': guard.fast_failures,
+            f'{kind}_deadlines_exceeded': guard.deadlines_exceeded,
+            f'{kind}_circuit_open': int( guard.breaker.is_open() ),
+        })
+    return stats
+
+
+# endregion
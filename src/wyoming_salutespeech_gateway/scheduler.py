@@ -0,0 +1,171 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+
+from . import app
+
+
+PRIORITY_INTERACTIVE: int = 0   # A user is waiting for the result, like a voice command transcription
+PRIORITY_NORMAL: int = 1        # Like an announcement synthesis
+PRIORITY_BULK: int = 2          # Nobody is waiting for the result
+
+
+class SchedulerBusyError(Exception):
+    """The request is rejected because the wait queue is full"""
+
+
+class Ticket:
+    """Groups the requests made for a job shared by several clients, like a synthesis, so its priority may be raised for all of them.
+    Set in the context of the job task, it is inherited by the sub-tasks, like the hedged attempts"""
+
+    def __init__(self, priority: int) -> None:
+        """ Constructor """
+
+        self.priority = priority
+
+
+current_ticket: ContextVar[Ticket | None] = ContextVar('ticket', default=None)
+
+
+class Scheduler:
+    """Admits upstream requests under the total and per-kind concurrency limits. Waiting requests are admitted by priority"""
+
+    def __init__(self, max_total: int, max_by_kind: dict[str, int], max_queued: int) -> None:
+        """ Constructor """
+
+        self._max_total = max_total
+        self._max_by_kind = max_by_kind
+        self._max_queued = max_queued
+        self._active_total = 0
+        self._active_by_kind: dict[str, int] = {kind: 0 for kind in max_by_kind}
+        self._waiters: list[tuple[int, int, str, asyncio.Future, Ticket | None]] = []  # A heap of (priority, sequence number, kind, future, ticket)
+        self._sequence = itertools.count()      # Keeps the order of the waiters having the same priority
+        self.admitted: int = 0
+        self.rejected: int = 0
+        self.wait_time_total: float = 0.0
+        self.wait_time_max: float = 0.0
+
+
+    @asynccontextmanager
+    async def slot(self, kind: str, priority: int) -> AsyncIterator[None]:
+        """Hold a slot for an upstream request, waiting in the queue if the limits are reached"""
+
+        await self._acquire(kind, priority)
+        try:
+            yield
+        finally:
+            self._release(kind)
+
+
+    def get_stats(self) -> dict[str, int | float]:
+        """Get the scheduler counters"""
+
+        return {
+            'queue_depth': len(self._waiters),
+            'active': self._active_total,
+            **{f'active_{kind}': active for kind, active in self._active_by_kind.items()},
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+
+    def promote(self, ticket: Ticket, priority: int) -> None:
+        """Raise the priority of the waiting and the future requests of the ticket, like when a user joins a bulk request in progress"""
+
+        ticket.priority = min(ticket.priority, priority)
+        promoted = False
+        for index, waiter in enumerate(self._waiters):
+            if waiter[4] is ticket and waiter[0] > priority:
+                self._waiters[index] = (priority, *waiter[1:])
+                promoted = True
+        if promoted:
+            heapq.heapify(self._waiters)
+            app.LOGGER.debug("A waiting upstream request is promoted to the priority %s.", priority)
+
+
+    def is_idle(self) -> bool:
+        """Check if no request is in progress or waiting"""
+
+        return not self._active_total and not self._waiters
+
+
+    def _can_admit(self, kind: str) -> bool:
+        """Check if the limits allow one more request of the kind"""
+
+        return self._active_total < self._max_total and self._active_by_kind[kind] < self._max_by_kind[kind]
+
+
+    def _admit(self, kind: str) -> None:
+        """Account an admitted request"""
+
+        self._active_total += 1
+        self._active_by_kind[kind] += 1
+        self.admitted += 1
+
+
+    async def _acquire(self, kind: str, priority: int) -> None:
+        """Wait for a slot. Raises SchedulerBusyError if the queue is full"""
+
+        if self._can_admit(kind):   # The remaining waiters, if any, are held by the limits of the other kinds
+            self._admit(kind)
+            return
+        if len(self._waiters) >= self._max_queued:
+            self.rejected += 1
+            raise SchedulerBusyError(f"{len(self._waiters)} upstream requests are already waiting")
+
+        start_time = time.time()
+        future = asyncio.get_running_loop().create_future()
+        ticket = current_ticket.get()
+        if ticket is not None:
+            priority = min(priority, ticket.priority)
+        heapq.heappush(self._waiters, (priority, next(self._sequence), kind, future, ticket))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(kind)     # The slot is granted right before the cancellation
+            else:
+                self._waiters = [waiter for waiter in self._waiters if waiter[3] is not future]
+                heapq.heapify(self._waiters)
+            raise
+        wait_time = time.time() - start_time
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        app.LOGGER.debug("An upstream '%s' request waited %.2f seconds in the queue; %s requests are still waiting.", kind, wait_time, len(self._waiters))
+
+
+    def _release(self, kind: str) -> None:
+        """Free the slot and admit the waiters the limits allow, most urgent first"""
+
+        self._active_total -= 1
+        self._active_by_kind[kind] -= 1
+        skipped = []
+        while self._waiters and self._active_total < self._max_total:
+            waiter = heapq.heappop(self._waiters)
+            if waiter[3].done():
+                continue
+            if self._can_admit(waiter[2]):
+                self._admit(waiter[2])
+                waiter[3].set_result(None)
+            else:
+                skipped.append(waiter)  # The kind limit is reached; let the other kinds pass
+        for waiter in skipped:
+            heapq.heappush(self._waiters, waiter)
+
+
+def create_scheduler() -> Scheduler:
+    """Create the scheduler with the configured limits"""
+
+    return Scheduler(
+        max_total=app.cli_args.max_concurrent_requests,
+        max_by_kind={'stt': app.cli_args.max_concurrent_stt_requests, 'tts': app.cli_args.max_concurrent_tts_requests},
+        max_queued=app.cli_args.max_queued_requests
+    )
@@ -2,15 +2,66 @@ __package__ = 'wyoming_salutespeech_gateway'
 
 import asyncio
 from functools import partial
+import json
 import math
+import signal
+import socket
 
 from wyoming.info import AsrModel, AsrProgram, TtsProgram, TtsVoice, Attribution, Info
-from wyoming.server import AsyncServer
+from wyoming.server import AsyncServer, HandlerFactory
+from wyoming.version import __version__ as wyoming_version
 
 from . import app
 from .event_handler import GatewayEventHandler
 
 
+_info_event_bytes: bytes | None = None    # The 'info' event as sent to the clients; the metadata never changes
+
+
+# region =============================================== Subroutines
+
+class _SharedSocketServer(AsyncServer):
+    """A Wyoming server accepting connections on a listening socket shared with other worker processes"""
+
+    def __init__(self, listen_socket: socket.socket) -> None:
+        """ Constructor """
+
+        super().__init__()
+        self._listen_socket = listen_socket
+
+
+    async def run(self, handler_factory: HandlerFactory) -> None:
+        """Serve the clients until SIGTERM, then shut down gracefully"""
+
+        handler_callback = partial(self._handler_callback, handler_factory)
+        if self._listen_socket.family == socket.AF_UNIX:
+            socket_server = await asyncio.start_unix_server(handler_callback, sock=self._listen_socket)
+        else:
+            socket_server = await asyncio.start_server(handler_callback, sock=self._listen_socket)
+        stop_requested = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_requested.set)
+        await stop_requested.wait()
+        socket_server.close()   # Stop accepting; the other workers keep serving the socket
+        await self._drain()
+
+
+    async def _drain(self) -> None:
+        """Let the clients finish the requests in progress, closing the idle connections, until the shutdown timeout"""
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + app.cli_args.shutdown_timeout
+        app.LOGGER.info("Shutting down: waiting for %s client connections to finish.", len(self._handlers))
+        while self._handlers and loop.time() < deadline:
+            for handler in list( self._handlers.values() ):
+                if not handler.is_busy():
+                    await handler.stop()
+            await asyncio.sleep(0.1)
+        tasks = list(self._handlers)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 # endregion
 # region =============================================== Interface
 
@@ -126,6 +177,17 @@ def get_wyoming_info() -> Info:
     )
 
 
+def get_wyoming_info_event() -> bytes:
+    """ Get the serialized 'info' event, the same as the Wyoming library writes. Built once, on the first call """
+
+    global _info_event_bytes
+    if _info_event_bytes is None:
+        data = json.dumps(get_wyoming_info().event().data, ensure_ascii=False).encode('utf-8')
+        header = json.dumps({'type': 'info', 'version': wyoming_version, 'data_length': len(data)}, ensure_ascii=False)
+        _info_event_bytes = header.encode('utf-8') + b"\n" + data
+    return _info_event_bytes
+
+
 def split_audio_into_chunks(audio: bytes):
     """ A generator function to split an audio stream into chunks """
 
@@ -136,10 +198,11 @@ def split_audio_into_chunks(audio: bytes):
         yield audio[offset: offset + bytes_per_chunk]
 
 
-async def run():
-    """ Start the Wyoming server """
+async def run(listen_socket: socket.socket | None = None):
+    """ Start the Wyoming server. A worker process serves the listening socket inherited from the supervisor """
 
-    wyoming_server = AsyncServer.from_uri(app.cli_args.listen_uri)
+    get_wyoming_info_event()    # Before the first client asks
+    wyoming_server = AsyncServer.from_uri(app.cli_args.listen_uri) if listen_socket is None else _SharedSocketServer(listen_socket)
     app.LOGGER.info("Wyoming server is instantiated.")
     await wyoming_server.run(
         partial(
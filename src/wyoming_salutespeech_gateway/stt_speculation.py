@@ -0,0 +1,129 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+
+from . import app, client, vad, trace
+
+
+_BYTES_PER_SECOND: int = 16000 * 2     # 16 kHz 16 bit mono
+
+fired_total: int = 0        # Speculative recognitions started, since the app start
+cancelled_total: int = 0    # Speculative recognitions made stale by new speech
+hits_total: int = 0         # Utterances transcribed by a speculative recognition
+misses_total: int = 0       # Utterances recognized once more after the audio end
+
+
+class _Speculation:
+    """A recognition of the audio received so far"""
+
+    def __init__(self, audio: bytes, audio_end: int, language: str) -> None:
+        """ Constructor """
+
+        self.audio_end = audio_end  # The length of the received audio the recognition covers
+        self.audio_size = len(audio)
+        self.task = asyncio.create_task( self._recognize(audio, language) )
+
+
+    @staticmethod
+    async def _recognize(audio: bytes, language: str) -> str:
+        """Recognize the audio prefix"""
+
+        with trace.span('speculation', audio_bytes=len(audio)):
+            return await client.recognize(audio, language)
+
+
+class SpeculativeRecognizer:
+    """Recognizes the utterance while it is still being received: on pauses in the speech and at intervals.
+    If no speech follows the audio of the latest recognition, its result is the transcript, available before the audio end.
+    The recognitions made stale by new speech are cancelled"""
+
+    def __init__(self, language: str, detector: vad.VoiceActivityDetector) -> None:
+        """ Constructor """
+
+        self._language = language
+        self._detector = detector
+        self._speculations: list[_Speculation] = []     # In progress or completed; the latest last
+        self._fired = 0
+
+
+    def update(self, audio: bytearray) -> None:
+        """Start a recognition of the audio received so far if the speech pauses or the interval passes.
+        Must be called after the voice activity detector processes each chunk"""
+
+        global fired_total
+        speech_end = self._detector.get_speech_end()
+        if speech_end is None:
+            return
+        self._cancel_stale(speech_end)
+        latest = self._speculations[-1] if self._speculations else None
+        if latest is not None and speech_end <= latest.audio_end:
+            return  # No new speech since the latest recognition
+        if self._fired >= app.cli_args.stt_speculation_max_requests:
+            return
+        paused = app.cli_args.stt_speculation_pause > 0 and self._detector.get_trailing_silence() >= app.cli_args.stt_speculation_pause
+        interval_passed = (
+            app.cli_args.stt_speculation_interval > 0
+            and len(audio) - (latest.audio_end if latest else 0) >= app.cli_args.stt_speculation_interval * _BYTES_PER_SECOND
+        )
+        if paused or interval_passed:
+            app.LOGGER.debug("Starting a speculative recognition of %.2f seconds of audio.", len(audio) / _BYTES_PER_SECOND)
+            with memoryview(audio) as audio_view:
+                prefix = bytes( self._detector.slice_speech(audio_view) if app.cli_args.vad else audio_view )   # A copy: the buffer keeps growing
+            self._speculations.append( _Speculation(prefix, len(audio), self._language) )
+            self._fired += 1
+            fired_total += 1
+
+
+    async def finish(self) -> str | None:
+        """Get the transcript if the latest recognition covers all the speech, waiting for it if needed.
+        Returns None if the utterance must be recognized as a whole"""
+
+        global hits_total, misses_total
+        speech_end = self._detector.get_speech_end()
+        if speech_end is not None:
+            self._cancel_stale(speech_end)
+        if not self._speculations or speech_end is None:
+            self.cancel()
+            if self._fired:
+                misses_total += 1
+            return None
+        speculation = self._speculations[-1]
+        text = await speculation.task
+        self.cancel()
+        if not text:    # Failed; the whole utterance gets another chance
+            misses_total += 1
+            return None
+        hits_total += 1
+        if app.cli_args.vad:    # Only the upload the transcript comes from counts, like a trimmed upload of the whole utterance
+            vad.account_saving(speculation.audio_end, speculation.audio_size)
+        return text
+
+
+    def cancel(self) -> None:
+        """Cancel the recognitions in progress"""
+
+        for speculation in self._speculations:
+            speculation.task.cancel()
+        self._speculations = []
+
+
+    def _cancel_stale(self, speech_end: int) -> None:
+        """Cancel the recognitions of the audio followed by new speech"""
+
+        global cancelled_total
+        for speculation in self._speculations:
+            if speech_end > speculation.audio_end and not speculation.task.done():
+                speculation.task.cancel()
+                cancelled_total += 1
+        self._speculations = [speculation for speculation in self._speculations if speech_end <= speculation.audio_end]
+
+
+def get_stats() -> dict[str, int]:
+    """Get the speculative recognition counters"""
+
+    return {
+        'fired': fired_total,
+        'cancelled': cancelled_total,
+        'hits': hits_total,
+        'misses': misses_total,
+    }
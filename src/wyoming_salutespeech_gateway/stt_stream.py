@@ -0,0 +1,45 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable
+
+from . import client
+
+
+StreamingRecognizer = Callable[[AsyncIterator[bytes], str], Awaitable[str]]
+
+
+class RecognitionStream:
+    """A recognition request started on the first audio chunk and fed with the next ones while the user is still speaking"""
+
+    def __init__(self, language: str, recognizer: StreamingRecognizer = client.recognize_stream) -> None:
+        """ Constructor. The recognizer is a transport uploading the audio chunks and returning the recognized text """
+
+        self._queue: asyncio.Queue[bytes | None] = asyncio.Queue()
+        self._task = asyncio.create_task( recognizer(self._read_audio(), language) )
+
+
+    def feed(self, audio: bytes) -> None:
+        """Pass the next audio chunk to the upload"""
+
+        self._queue.put_nowait(audio)
+
+
+    async def finish(self) -> str:
+        """Complete the upload and wait for the recognized text"""
+
+        self._queue.put_nowait(None)
+        return await self._task
+
+
+    def cancel(self) -> None:
+        """Abandon the recognition"""
+
+        self._task.cancel()
+
+
+    async def _read_audio(self) -> AsyncIterator[bytes]:
+        """Yield the audio chunks until the upload is completed"""
+
+        while (audio := await self._queue.get()) is not None:
+            yield audio
@@ -0,0 +1,180 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+from uuid import uuid4
+
+from . import app
+
+
+_EXPORT_INTERVAL: float = 1.0      # How often the sampled records are appended to the export file, in seconds
+_MAX_PENDING_RECORDS: int = 1000   # Records waiting for the export; more are dropped if the file does not keep up
+
+_current_trace: ContextVar['Trace | None'] = ContextVar('trace', default=None)     # Inherited by the tasks a request starts
+_pending_records: list[str] = []
+_export_task: asyncio.Task | None = None
+
+
+class Trace:
+    """The timings of a single utterance or synthesis, as spans relative to its start"""
+
+    def __init__(self, kind: str, session_id: str) -> None:
+        """ Constructor """
+
+        self.trace_id = new_id()
+        self.session_id = session_id
+        self.kind = kind
+        self.start_timestamp = time.time()
+        self.start_time = time.monotonic()     # The same clock as the event loop time
+        self._spans: list[dict] = []
+        self._totals: dict[str, dict] = {}     # Spans accumulated over many short steps, like the conversion of each audio chunk
+        self.attributes: dict = {}
+
+
+    def add_span(self, name: str, start_time: float, end_time: float, **attributes) -> None:
+        """Record a step by its monotonic start and end times"""
+
+        self._spans.append({
+            'name': name,
+            'start_ms': round((start_time - self.start_time) * 1000, 1),
+            'duration_ms': round((end_time - start_time) * 1000, 1),
+            **attributes
+        })
+
+
+    def accumulate(self, name: str, start_time: float, end_time: float) -> None:
+        """Add the time of a repeated step to its total"""
+
+        total = self._totals.get(name)
+        if total is None:
+            total = self._totals[name] = {'name': name, 'start_ms': round((start_time - self.start_time) * 1000, 1), 'duration_ms': 0.0, 'count': 0}
+        total['duration_ms'] += (end_time - start_time) * 1000
+        total['count'] += 1
+
+
+    def to_record(self) -> dict:
+        """Get the structured timing record"""
+
+        totals = [{**total, 'duration_ms': round(total['duration_ms'], 1)} for total in self._totals.values()]
+        return {
+            'trace_id': self.trace_id,
+            'session_id': self.session_id,
+            'kind': self.kind,
+            'timestamp': round(self.start_timestamp, 3),
+            'duration_ms': round((time.monotonic() - self.start_time) * 1000, 1),
+            **self.attributes,
+            'spans': sorted(self._spans + totals, key=lambda span: span['start_ms']),
+        }
+
+
+# region =============================================== Subroutines
+
+def _write_records(records: list[str]) -> None:
+    """Append the records to the export file in a single write. Blocking"""
+
+    with open(app.cli_args.trace_file, 'a', encoding='utf-8') as trace_file:
+        trace_file.write( ''.join(records) )
+
+
+async def _run_export() -> None:
+    """Append the sampled records to the export file periodically, off the event loop"""
+
+    while True:
+        await asyncio.sleep(_EXPORT_INTERVAL)
+        await _flush()
+
+
+async def _flush() -> None:
+    """Append the pending records to the export file"""
+
+    global _pending_records
+    if not _pending_records:
+        return
+    records, _pending_records = _pending_records, []
+    try:
+        await asyncio.to_thread(_write_records, records)
+    except OSError as err:
+        app.LOGGER.warning("Failed to export %s trace records: %s.", len(records), err)
+
+
+# endregion
+# region =============================================== Interface
+
+def new_id() -> str:
+    """Get a new trace or session ID"""
+
+    return uuid4().hex[:16]
+
+
+def begin(kind: str, session_id: str) -> Trace:
+    """Start tracing an utterance or a synthesis in the current task and the tasks it starts"""
+
+    trace = Trace(kind, session_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish(trace: Trace) -> None:
+    """Log the timing record of the trace, and export it if it is sampled"""
+
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+    log_enabled = app.LOGGER.isEnabledFor(logging.INFO)
+    export_enabled = bool(app.cli_args.trace_file) and random.random() < app.cli_args.trace_sample_rate
+    if not log_enabled and not export_enabled:
+        return
+    record = json.dumps(trace.to_record(), ensure_ascii=False)
+    if log_enabled:
+        app.LOGGER.info("Trace: %s", record)
+    if export_enabled and len(_pending_records) < _MAX_PENDING_RECORDS:
+        _pending_records.append(record + '\n')
+
+
+def add_span(name: str, start_time: float, end_time: float, **attributes) -> None:
+    """Record a step by its monotonic start and end times in the current trace, if any"""
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start_time, end_time, **attributes)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    """Record the time of the enclosed step in the current trace, if any"""
+
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start_time, time.monotonic(), **attributes)
+
+
+def start_export() -> None:
+    """Start appending the sampled records to the export file, if configured"""
+
+    global _export_task
+    if app.cli_args.trace_file and _export_task is None:
+        _export_task = asyncio.create_task(_run_export())
+
+
+async def stop_export() -> None:
+    """Export the pending records and stop"""
+
+    global _export_task
+    if _export_task is not None:
+        _export_task.cancel()
+        _export_task = None
+        await _flush()
+
+
+# endregion
@@ -0,0 +1,365 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from . import app, client, scheduler, audio_format, trace
+
+
+_DISK_EVICTION_WATERMARK: float = 0.9     # Evict down to this share of the size limit, not to re-sort the items on every put
+_DISK_RESCAN_INTERVAL: float = 60.0       # How often a put re-reads the directory to account the items of the other worker processes, in seconds
+
+_in_flight: dict[str, '_InFlight'] = {}    # Synthesis requests in progress by the cache key, shared by identical requests
+
+
+# region =============================================== Cache tiers
+
+class MemoryCache:
+    """An in-memory LRU cache of synthesized audio, bounded by the total audio size"""
+
+    def __init__(self, max_bytes: int) -> None:
+        """ Constructor """
+
+        self._max_bytes = max_bytes
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self.size: int = 0
+        self.evictions: int = 0
+
+
+    def get(self, key: str) -> bytes | None:
+        """Get the audio and mark it as recently used. Returns None on a miss"""
+
+        audio = self._items.get(key)
+        if audio is not None:
+            self._items.move_to_end(key)
+        return audio
+
+
+    def contains(self, key: str) -> bool:
+        """Check if the audio is cached, not marking it as recently used"""
+
+        return key in self._items
+
+
+    def put(self, key: str, audio: bytes) -> None:
+        """Store the audio, evicting the least recently used items to fit the size limit"""
+
+        if len(audio) > self._max_bytes:
+            return
+        if key in self._items:
+            self.size -= len( self._items.pop(key) )
+        self._items[key] = audio
+        self.size += len(audio)
+        while self.size > self._max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+
+class DiskCache:
+    """A persistent on-disk cache of synthesized audio with TTL and size-based eviction of the oldest items.
+    The worker processes share the directory: the items stored by the others are found on disk and accounted by periodic rescans"""
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float) -> None:
+        """ Constructor """
+
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._items: dict[str, tuple[int, float]] = {}  # Key -> (size, modification time)
+        self._lock = threading.Lock()                   # The methods run in worker threads
+        self._scanned_at: float = 0.0
+        self.size: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+
+
+    def open(self) -> None:
+        """Create the cache directory and account the items stored by previous runs. Blocking"""
+
+        os.makedirs(self._directory, exist_ok=True)
+        items = self._scan()    # Without the lock: the cache serves the requests meanwhile
+        with self._lock:
+            self._set_items(items)
+        app.LOGGER.debug("TTS disk cache is opened: %s items, %s bytes.", len(self._items), self.size)
+
+
+    def get(self, key: str) -> bytes | None:
+        """Get the audio. Returns None on a miss or if the item is expired. Blocking"""
+
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                return None
+            if time.time() - item[1] > self._ttl:
+                self._remove(key)
+                self.expirations += 1
+                return None
+        try:
+            with open(self._get_path(key), 'rb') as audio_file:
+                return audio_file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._remove(key)
+            return None
+
+
+    def contains(self, key: str) -> bool:
+        """Check if the audio is cached and not expired. Blocking"""
+
+        with self._lock:
+            item = self._lookup(key)
+            return item is not None and time.time() - item[1] <= self._ttl
+
+
+    def put(self, key: str, audio: bytes) -> None:
+        """Store the audio, evicting the oldest items to fit the size limit. Blocking"""
+
+        if len(audio) > self._max_bytes:
+            return
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"   # Unique across the worker processes
+        with open(temp_path, 'wb') as audio_file:
+            audio_file.write(audio)
+        os.replace(temp_path, path)     # Readers never see a partially written item
+
+        rescanned_items = self._scan() if time.time() - self._scanned_at > _DISK_RESCAN_INTERVAL else None
+        with self._lock:
+            if rescanned_items is not None:
+                self._set_items(rescanned_items)    # Including the new item
+            else:
+                if key in self._items:
+                    self.size -= self._items[key][0]
+                self._items[key] = (len(audio), time.time())
+                self.size += len(audio)
+            if self.size > self._max_bytes:
+                for evicted_key, _ in sorted(self._items.items(), key=lambda item: item[1][1]):
+                    self._remove(evicted_key)
+                    self.evictions += 1
+                    if self.size <= self._max_bytes * _DISK_EVICTION_WATERMARK:
+                        break
+
+
+    def _get_path(self, key: str) -> str:
+        """Get the item file path. The items are spread over subdirectories to keep the directories small"""
+
+        return os.path.join(self._directory, key[:2], f"{key}.pcm")
+
+
+    def _scan(self) -> dict[str, tuple[int, float]]:
+        """Read the items in the directory, including the ones stored by the other worker processes. Blocking"""
+
+        self._scanned_at = time.time()
+        items = {}
+        for subdir in os.scandir(self._directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.pcm'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:   # Evicted by another worker process meanwhile
+                        continue
+                    items[ entry.name[:-4] ] = (stat.st_size, stat.st_mtime)
+        return items
+
+
+    def _set_items(self, items: dict[str, tuple[int, float]]) -> None:
+        """Replace the accounted items with the scanned ones. Must be called with the lock held"""
+
+        self._items = items
+        self.size = sum(item[0] for item in items.values())
+
+
+    def _lookup(self, key: str) -> tuple[int, float] | None:
+        """Get the item size and modification time, looking for the file if another worker process has stored it since the last scan.
+        Must be called with the lock held"""
+
+        item = self._items.get(key)
+        if item is None:
+            try:
+                stat = os.stat( self._get_path(key) )
+            except FileNotFoundError:
+                return None
+            item = self._items[key] = (stat.st_size, stat.st_mtime)
+            self.size += stat.st_size
+        return item
+
+
+    def _remove(self, key: str) -> None:
+        """Remove the item, if it is not removed already, like by a concurrent eviction. Must be called with the lock held"""
+
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[0]
+        try:
+            os.remove( self._get_path(key) )
+        except FileNotFoundError:
+            pass
+
+
+class TtsCache:
+    """A two-tier cache of synthesized audio: the memory LRU in front of the optional persistent disk store"""
+
+    def __init__(self) -> None:
+        """ Constructor """
+
+        self._memory = MemoryCache(app.cli_args.tts_cache_memory_size * 1024 * 1024)
+        self._disk: DiskCache | None = None
+        if app.cli_args.tts_cache_dir:
+            self._disk = DiskCache(
+                directory=app.cli_args.tts_cache_dir,
+                max_bytes=app.cli_args.tts_cache_disk_size * 1024 * 1024,
+                ttl=app.cli_args.tts_cache_ttl
+            )
+        self.memory_hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0     # Requests served by an identical request in progress
+
+
+    async def open(self) -> None:
+        """Prepare the cache for use"""
+
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.open)
+
+
+    async def get(self, key: str) -> bytes | None:
+        """Get the audio from the fastest tier having it. Returns None on a miss"""
+
+        audio = self._memory.get(key)
+        if audio is not None:
+            self.memory_hits += 1
+            return audio
+        if self._disk is not None:
+            audio = await asyncio.to_thread(self._disk.get, key)
+            if audio is not None:
+                self.disk_hits += 1
+                self._memory.put(key, audio)
+                return audio
+        self.misses += 1
+        return None
+
+
+    async def contains(self, key: str) -> bool:
+        """Check if any tier has the audio, not counting a hit or a miss"""
+
+        return self._memory.contains(key) or (self._disk is not None and await asyncio.to_thread(self._disk.contains, key))
+
+
+    async def put(self, key: str, audio: bytes) -> None:
+        """Store the audio in all the tiers"""
+
+        self._memory.put(key, audio)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.put, key, audio)
+
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the cache counters"""
+
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'memory_evictions': self._memory.evictions,
+            'memory_size': self._memory.size,
+            'disk_evictions': self._disk.evictions if self._disk else 0,
+            'disk_expirations': self._disk.expirations if self._disk else 0,
+            'disk_size': self._disk.size if self._disk else 0,
+        }
+
+
+class _InFlight:
+    """A synthesis in progress, shared by identical requests"""
+
+    def __init__(self, ticket: scheduler.Ticket, source_key: str | None) -> None:
+        """ Constructor """
+
+        self.ticket = ticket                # Has the most urgent priority of the requests waiting for it
+        self.source_key = source_key        # The synthesis in the native format it converts, if any
+        self.task: asyncio.Task | None = None
+
+
+# endregion
+# region =============================================== Subroutines
+
+async def _synthesize(key: str, text: str, language: str, voice: str, output_format: audio_format.AudioFormat, priority: int) -> bytes:
+    """Get the audio from the cache or the cloud. Audio in a non-native format is converted from the cached original"""
+
+    audio = await app.tts_audio_cache.get(key)
+    if audio is not None:
+        if app.LOGGER.isEnabledFor(logging.DEBUG):     # Not to collect the stats for nothing
+            app.LOGGER.debug("The synthesized audio is found in the cache: %s.", app.tts_audio_cache.get_stats())
+        return audio
+
+    priority = min(priority, scheduler.current_ticket.get().priority)   # Raised if a more urgent request has joined meanwhile
+    source_format = audio_format.get_source_format(output_format)
+    if output_format == source_format:
+        audio = await client.synthesize(text=text, language=language, voice=audio_format.get_voice(voice, source_format), priority=priority, rate=source_format.rate)
+    else:
+        source_audio = await synthesize(text, language, voice, source_format, priority)
+        with trace.span('convert', rate=output_format.rate):
+            audio = await audio_format.convert_async(source_audio, source_format, output_format)
+    if audio:
+        await app.tts_audio_cache.put(key, audio)
+    if app.LOGGER.isEnabledFor(logging.DEBUG):     # Not to collect the stats for nothing
+        app.LOGGER.debug("The synthesized audio is not found in the cache: %s.", app.tts_audio_cache.get_stats())
+    return audio
+
+
+def _promote(key: str, priority: int) -> None:
+    """Raise the priority of the synthesis in progress and the one it converts, so a user joining a bulk request does not wait at the bulk priority"""
+
+    entry = _in_flight.get(key)
+    if entry is None or entry.ticket.priority <= priority:
+        return
+    app.request_scheduler.promote(entry.ticket, priority)
+    if entry.source_key is not None:
+        _promote(entry.source_key, priority)
+
+
+# endregion
+# region =============================================== Interface
+
+def get_key(text: str, language: str, voice: str, output_format: audio_format.AudioFormat = audio_format.NATIVE_FORMAT) -> str:
+    """Get a content address of the synthesized audio"""
+
+    normalized_text = ' '.join( unicodedata.normalize('NFC', text).split() )
+    format_tag = f"pcm:{output_format.rate}:{output_format.width}:{output_format.channels}"
+    return hashlib.sha256( '\n'.join((normalized_text, language, voice, format_tag)).encode('utf-8') ).hexdigest()
+
+
+async def synthesize(text: str, language: str, voice: str, output_format: audio_format.AudioFormat = audio_format.NATIVE_FORMAT,
+                     priority: int = scheduler.PRIORITY_NORMAL) -> bytes:
+    """Synthesize the speech in the format, using the cached audio if any. Concurrent identical requests share a single cloud call"""
+
+    key = get_key(text, language, voice, output_format)
+    entry = _in_flight.get(key)
+    if entry is None:
+        source_format = audio_format.get_source_format(output_format)
+        source_key = get_key(text, language, voice, source_format) if source_format != output_format else None
+        entry = _InFlight(scheduler.Ticket(priority), source_key)
+        context = contextvars.copy_context()
+        context.run(scheduler.current_ticket.set, entry.ticket)     # The cloud requests of the synthesis wait with its ticket
+        entry.task = asyncio.create_task(_synthesize(key, text, language, voice, output_format, priority), context=context)
+        _in_flight[key] = entry
+        entry.task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    else:
+        app.tts_audio_cache.coalesced += 1
+        app.LOGGER.debug("The same text is being synthesized for another client, waiting for its audio.")
+        _promote(key, priority)
+    return await asyncio.shield(entry.task)     # A disconnecting client does not cancel the synthesis the others wait for
+
+
+# endregion
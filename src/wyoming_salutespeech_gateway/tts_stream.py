@@ -0,0 +1,63 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import re
+from typing import AsyncIterator
+
+from . import app, tts_cache, audio_format
+
+
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+')
+_CLAUSE_BOUNDARY = re.compile(r'(?<=[,;:—])\s+')
+_MAX_SEGMENT_LENGTH: int = 300  # Longer sentences are split into clauses
+
+
+# region =============================================== Interface
+
+def split_text(text: str) -> list[str]:
+    """Split the text into sentences, and too long sentences into clauses. Too short segments are merged with the next ones"""
+
+    pieces: list[str] = []
+    for sentence in _SENTENCE_BOUNDARY.split( text.strip() ):
+        if len(sentence) > _MAX_SEGMENT_LENGTH:
+            pieces.extend( _CLAUSE_BOUNDARY.split(sentence) )
+        else:
+            pieces.append(sentence)
+
+    segments: list[str] = []
+    for piece in pieces:
+        if not piece:
+            continue
+        if segments and len(segments[-1]) < app.cli_args.tts_stream_min_segment_length:
+            segments[-1] += ' ' + piece
+        else:
+            segments.append(piece)
+    return segments
+
+
+async def synthesize(text: str, language: str, voice: str, output_format: audio_format.AudioFormat = audio_format.NATIVE_FORMAT) -> AsyncIterator[bytes]:
+    """Synthesize the speech in the format, yielding audio segment by segment in the text order.
+    In the streaming mode the segments are synthesized concurrently, so the first one is available early"""
+
+    if not app.cli_args.tts_streaming:
+        yield await tts_cache.synthesize(text=text, language=language, voice=voice, output_format=output_format)
+        return
+
+    segments = split_text(text)
+    app.LOGGER.debug("The text is split into %s segments to synthesize.", len(segments))
+    semaphore = asyncio.Semaphore(app.cli_args.tts_stream_parallelism)
+
+    async def synthesize_segment(segment: str) -> bytes:
+        async with semaphore:   # Acquired in the text order, so the earlier segments are synthesized first
+            return await tts_cache.synthesize(text=segment, language=language, voice=voice, output_format=output_format)
+
+    tasks = [asyncio.create_task( synthesize_segment(segment) ) for segment in segments]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# endregion
@@ -0,0 +1,112 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import numpy as np
+
+from . import app
+
+
+_SAMPLE_RATE: int = 16000
+_SAMPLE_WIDTH: int = 2
+_FRAME_DURATION: float = 0.03                                           # In seconds
+_FRAME_SIZE: int = int(_SAMPLE_RATE * _FRAME_DURATION) * _SAMPLE_WIDTH  # In bytes
+_MIN_SPEECH_FRAMES: int = 3     # Shorter loud sounds, like clicks, are not considered speech
+
+saved_bytes_total: int = 0      # Audio not uploaded thanks to the trimming, since the app start
+
+
+class VoiceActivityDetector:
+    """An energy-based voice activity detector over 16 kHz 16-bit mono audio, fed chunk by chunk"""
+
+    def __init__(self) -> None:
+        """ Constructor """
+
+        self._threshold = app.cli_args.vad_threshold
+        self._padding_frames = int(app.cli_args.vad_padding / _FRAME_DURATION)
+        self._end_silence_frames = int(app.cli_args.vad_end_silence / _FRAME_DURATION)
+        self._pending = bytearray()     # A tail of the audio not filling a whole frame yet
+        self._tail_flags = np.zeros(0, dtype=np.int8)   # Loudness flags of the last frames, to find speech spanning chunks
+        self._frames_number = 0
+        self._first_speech_frame: int | None = None
+        self._last_speech_frame: int | None = None
+
+
+    def process(self, audio: bytes) -> None:
+        """Detect speech in the next audio chunk"""
+
+        self._pending.extend(audio)
+        frames_number = len(self._pending) // _FRAME_SIZE
+        if not frames_number:
+            return
+        samples = np.frombuffer(self._pending, dtype='<i2', count=frames_number * _FRAME_SIZE // _SAMPLE_WIDTH)
+        frames = samples.reshape(frames_number, -1).astype(np.float32) / 32768.0
+        levels = 10.0 * np.log10( np.mean(frames * frames, axis=1) + 1e-10 )   # RMS level of every frame, in dBFS
+        del samples, frames     # Release the buffer export before resizing the pending audio
+        del self._pending[: frames_number * _FRAME_SIZE]
+
+        flags = np.concatenate(( self._tail_flags, (levels > self._threshold).astype(np.int8) ))
+        speech_runs = np.flatnonzero( np.convolve(flags, np.ones(_MIN_SPEECH_FRAMES, dtype=np.int8), 'valid') == _MIN_SPEECH_FRAMES )
+        flags_offset = self._frames_number - len(self._tail_flags)
+        if speech_runs.size:
+            if self._first_speech_frame is None:
+                self._first_speech_frame = flags_offset + int(speech_runs[0])
+            self._last_speech_frame = flags_offset + int(speech_runs[-1]) + _MIN_SPEECH_FRAMES - 1
+        self._tail_flags = flags[-(_MIN_SPEECH_FRAMES - 1):]
+        self._frames_number += frames_number
+
+
+    def is_speech_detected(self) -> bool:
+        """Check if the audio processed so far contains speech"""
+
+        return self._first_speech_frame is not None
+
+
+    def is_speech_ended(self) -> bool:
+        """Check if the speech is followed by a silence long enough to end the utterance. Always False if disabled"""
+
+        return (
+            self._end_silence_frames > 0
+            and self._last_speech_frame is not None
+            and self._frames_number - self._last_speech_frame - 1 >= self._end_silence_frames
+        )
+
+
+    def get_speech_end(self) -> int | None:
+        """Get the offset of the end of the last speech in the processed audio, in bytes. Returns None if there is no speech yet"""
+
+        if self._last_speech_frame is None:
+            return None
+        return (self._last_speech_frame + 1) * _FRAME_SIZE
+
+
+    def get_trailing_silence(self) -> float:
+        """Get the duration of the silence after the last speech, in seconds"""
+
+        if self._last_speech_frame is None:
+            return 0.0
+        return (self._frames_number - self._last_speech_frame - 1) * _FRAME_DURATION
+
+
+    def trim(self, audio: memoryview) -> memoryview:
+        """Cut the leading and trailing silence off the processed audio, keeping some padding around the speech, and account the saving"""
+
+        trimmed_audio = self.slice_speech(audio)
+        account_saving(len(audio), len(trimmed_audio))
+        return trimmed_audio
+
+
+    def slice_speech(self, audio: memoryview) -> memoryview:
+        """Get the speech in the processed audio with some padding around it, not accounting the saving"""
+
+        if self._first_speech_frame is None:
+            return audio[:0]
+        start = max(0, self._first_speech_frame - self._padding_frames) * _FRAME_SIZE
+        end = (self._last_speech_frame + 1 + self._padding_frames) * _FRAME_SIZE
+        return audio[start:end]
+
+
+def account_saving(audio_size: int, uploaded_size: int) -> None:
+    """Account the audio not uploaded thanks to the trimming"""
+
+    global saved_bytes_total
+    saved_bytes_total += audio_size - uploaded_size
+    app.LOGGER.debug("Silence trimming saved %s of %s bytes; %s bytes in total.", audio_size - uploaded_size, audio_size, saved_bytes_total)
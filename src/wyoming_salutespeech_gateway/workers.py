@@ -0,0 +1,135 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+from urllib.parse import urlparse
+
+from . import app, auth, client
+
+
+_RESTART_DELAY: float = 1.0        # A pause before restarting a failed process, not to spin on a persistent failure
+_KILL_GRACE_PERIOD: float = 5.0    # Extra time for a stopping process over the shutdown timeout before it is killed
+
+_fork_context = multiprocessing.get_context('fork')     # The processes inherit the parsed arguments and the listening socket
+
+
+# region =============================================== Subroutines
+
+def _create_listen_socket() -> socket.socket:
+    """Bind the Wyoming listening socket the worker processes inherit"""
+
+    uri = urlparse(app.cli_args.listen_uri)
+    if uri.scheme == 'tcp':
+        if (uri.hostname is None) or (uri.port is None):
+            raise ValueError("A port must be specified when using a 'tcp://' URI")
+        return socket.create_server((uri.hostname, uri.port))
+    if uri.scheme == 'unix':
+        if os.path.exists(uri.path):
+            os.remove(uri.path)
+        listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listen_socket.bind(uri.path)
+        listen_socket.listen()
+        return listen_socket
+    raise ValueError("Only 'unix://' or 'tcp://' are supported with multiple workers")
+
+
+def _run_worker(worker_number: int, listen_socket: socket.socket, shared_tokens: list[auth.SharedToken]) -> None:
+    """Serve the Wyoming clients in a worker process"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl+C reaches the whole process group; the supervisor stops the workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)    # The supervisor forwards it to the pre-warmer of the first worker
+    app.worker_number = worker_number
+    asyncio.run( app._run(listen_socket, shared_tokens) )
+
+
+def _run_token_keeper(shared_tokens: list[auth.SharedToken]) -> None:
+    """Keep the access tokens shared by the workers fresh, so they do not authenticate each on its own"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.run( _keep_tokens(shared_tokens) )
+
+
+async def _keep_tokens(shared_tokens: list[auth.SharedToken]) -> None:
+    """Refresh the shared access tokens of all the keys in the background until SIGTERM"""
+
+    stop_requested = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_requested.set)
+    await client.open_http_session()
+    token_managers = [auth.TokenManager(auth_key, shared_token) for auth_key, shared_token in zip(auth.get_auth_keys(), shared_tokens)]
+    try:
+        for token_manager in token_managers:
+            token_manager.start()
+        await stop_requested.wait()
+    finally:
+        for token_manager in token_managers:
+            await token_manager.stop()
+        await client.close_http_session()
+
+
+def _start_process(name: str, target, *args) -> multiprocessing.Process:
+    """Start a child process"""
+
+    process = _fork_context.Process(target=target, args=args, name=name, daemon=True)
+    process.start()
+    app.LOGGER.debug("The %s process is started with PID %s.", name, process.pid)
+    return process
+
+
+# endregion
+# region =============================================== Interface
+
+def run_supervisor() -> None:
+    """Run the worker processes sharing one listening socket and the access tokens, restarting the failed ones.
+    Must be called before any event loop is created, as the processes are forked"""
+
+    listen_socket = _create_listen_socket()
+    shared_tokens = [auth.SharedToken(_fork_context) for _ in auth.get_auth_keys()]
+    targets = {'token keeper': (_run_token_keeper, shared_tokens)}
+    for worker_number in range(app.cli_args.workers):
+        targets[f'worker {worker_number}'] = (_run_worker, worker_number, listen_socket, shared_tokens)
+
+    processes: dict[str, multiprocessing.Process] = {}
+    stop_requested = False
+    def request_stop(signal_number, frame) -> None:
+        nonlocal stop_requested
+        stop_requested = True
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    def request_reload(signal_number, frame) -> None:
+        worker = processes.get('worker 0')
+        if worker is not None and worker.is_alive():    # The TTS cache pre-warmer runs there
+            os.kill(worker.pid, signal.SIGHUP)
+    signal.signal(signal.SIGHUP, request_reload)
+
+    processes.update( (name, _start_process(name, *target)) for name, target in targets.items() )
+    app.LOGGER.info("Wyoming server is running in %s worker processes.", app.cli_args.workers)
+    while not stop_requested:
+        multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout=1.0)
+        for name, process in list( processes.items() ):
+            if not process.is_alive() and not stop_requested:
+                app.LOGGER.warning("The %s process exited with the code %s; restarting it.", name, process.exitcode)
+                time.sleep(_RESTART_DELAY)
+                processes[name] = _start_process(name, *targets[name])
+
+    app.LOGGER.info('Wyoming-Salutespeech Gateway is stopping.')
+    for process in processes.values():
+        process.terminate()     # SIGTERM: the workers stop accepting and let the clients finish their requests
+    deadline = time.time() + app.cli_args.shutdown_timeout + _KILL_GRACE_PERIOD
+    for name, process in processes.items():
+        process.join( max(0.0, deadline - time.time()) )
+        if process.is_alive():
+            app.LOGGER.warning("The %s process did not stop in time; killing it.", name)
+            process.kill()
+            process.join()
+    listen_socket.close()
+    if listen_socket.family == socket.AF_UNIX:
+        os.remove( urlparse(app.cli_args.listen_uri).path )
+
+
+# endregion
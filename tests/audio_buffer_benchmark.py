@@ -0,0 +1,28 @@
+""" Compare the utterance accumulation by bytes concatenation and by a growable bytearray """
+
+import timeit
+
+
+CHUNK = bytes(640)  # 20 ms of 16 kHz 16-bit mono audio
+
+
+def accumulate_bytes(chunks_number: int) -> bytes:
+    audio = b""
+    for _ in range(chunks_number):
+        audio += CHUNK
+    return audio
+
+
+def accumulate_bytearray(chunks_number: int) -> memoryview:
+    audio = bytearray()
+    for _ in range(chunks_number):
+        audio.extend(CHUNK)
+    return memoryview(audio)
+
+
+print(f"{'utterance, s':>12} {'bytes, ms':>10} {'bytearray, ms':>14}")
+for seconds in (15, 30, 60, 120, 240):
+    chunks_number = seconds * 50
+    bytes_time = min( timeit.repeat(lambda: accumulate_bytes(chunks_number), number=1, repeat=3) )
+    bytearray_time = min( timeit.repeat(lambda: accumulate_bytearray(chunks_number), number=1, repeat=3) )
+    print(f"{seconds:>12} {bytes_time * 1000:>10.2f} {bytearray_time * 1000:>14.2f}")
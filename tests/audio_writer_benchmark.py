@@ -0,0 +1,63 @@
+""" Compare the CPU time of sending synthesized audio to a Wyoming client event by event and in batched writes.
+Run from the repository root, like: python3 tests/audio_writer_benchmark.py """
+
+__package__ = 'wyoming_salutespeech_gateway'
+
+import argparse
+import asyncio
+import logging
+import time
+
+from wyoming.audio import AudioChunk
+from wyoming.event import async_read_event, async_write_event
+
+from . import app, audio_writer, server
+
+
+AUDIO = bytes(24000 * 2 * 10)   # 10 seconds of 24 kHz 16-bit mono audio, like a long announcement
+REPEATS = 20
+
+
+async def send_event_by_event(writer: asyncio.StreamWriter) -> None:
+    for chunk in server.split_audio_into_chunks(AUDIO):
+        await async_write_event(AudioChunk(audio=bytes(chunk), rate=24000, width=2, channels=1).event(), writer)
+
+
+async def send_batched(writer: asyncio.StreamWriter) -> None:
+    await audio_writer.AudioWriter(writer, rate=24000, width=2, channels=1).write(AUDIO)
+
+
+async def measure(send) -> tuple[float, int]:
+    """ Get the CPU time per second of audio, in ms, and the number of events the client received """
+
+    events_received = 0
+    received = asyncio.Event()
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal events_received
+        while await async_read_event(reader) is not None:
+            events_received += 1
+        received.set()
+
+    socket_server = await asyncio.start_server(receive, "127.0.0.1", 0)
+    _, writer = await asyncio.open_connection("127.0.0.1", socket_server.sockets[0].getsockname()[1])
+    start_cpu_time = time.process_time()
+    for _ in range(REPEATS):
+        await send(writer)
+    writer.close()
+    await received.wait()
+    cpu_time = time.process_time() - start_cpu_time     # Includes the client reading all the events
+    socket_server.close()
+    return cpu_time * 1000 / (len(AUDIO) / 48000 * REPEATS), events_received
+
+
+async def main() -> None:
+    print(f"{'':>16} {'CPU per audio second, ms':>25} {'events':>8}")
+    for name, send in (("event by event", send_event_by_event), ("batched", send_batched)):
+        cpu_time, events_received = await measure(send)
+        print(f"{name:>16} {cpu_time:>25.3f} {events_received:>8}")
+
+
+app.cli_args = argparse.Namespace(chunk_size=1024, max_chunk_size=8192, write_batch_size=64)
+app.LOGGER = logging.getLogger()
+asyncio.run( main() )
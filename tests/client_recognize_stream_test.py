@@ -0,0 +1,53 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio, os, sys, wave
+from wyoming.audio import AudioChunk, AudioChunkConverter
+# noinspection PyUnresolvedReferences
+from . import app
+# noinspection PyUnresolvedReferences
+from . import client
+# noinspection PyUnresolvedReferences
+from . import auth
+# noinspection PyUnresolvedReferences
+from . import scheduler
+# noinspection PyUnresolvedReferences
+from . import stt_stream
+import mock_salutespeech
+
+
+# Run against the local stand-in of the cloud services
+sys.argv += ["--sber-auth-url", "http://127.0.0.1:9443/api/v2/oauth", "--salutespeech-url", "http://127.0.0.1:9443/rest/v1"]
+app.parse_arguments()
+app.setup_custom_logger("root")
+
+
+async def main() -> str:
+    mock_runner = await mock_salutespeech.start("127.0.0.1", 9443)
+    await client.open_http_session()
+    app.credential_pool = auth.create_credential_pool()
+    app.request_scheduler = scheduler.create_scheduler()
+    try:
+        filename = os.path.dirname(os.path.abspath(__file__)) + "/samples/sample2.wav"
+        wav_file: wave.Wave_read = wave.open(filename, "rb")
+        with wav_file:
+            audio_converter = AudioChunkConverter(rate=16000, width=2, channels=1)
+            frames_per_chunk = wav_file.getframerate() // 10
+            recognition_stream = stt_stream.RecognitionStream(language="ru-RU")
+            while frames := wav_file.readframes(frames_per_chunk):
+                chunk = AudioChunk(rate=wav_file.getframerate(), width=wav_file.getsampwidth(), channels=wav_file.getnchannels(), audio=frames)
+                recognition_stream.feed( audio_converter.convert(chunk).audio )
+                await asyncio.sleep(0.1)    # Imitate a real-time audio source
+        text = await recognition_stream.finish()
+
+        request = mock_runner.app['recognize_requests'][0]
+        print(f"Chunked upload: {request['chunked']}, {request['size']} bytes.")
+        print(f"The upload started {request['completed_at'] - request['first_byte_at']:.2f} seconds before the audio end.")
+        return text
+    finally:
+        await client.close_http_session()
+        await mock_runner.cleanup()
+
+
+text = asyncio.run( main() )
+
+print(text)
@@ -1,19 +1,34 @@
 __package__ = 'wyoming_salutespeech_gateway'
 
+import asyncio
 import os
 # noinspection PyUnresolvedReferences
 from . import app
 # noinspection PyUnresolvedReferences
 from . import client
+# noinspection PyUnresolvedReferences
+from . import auth
+# noinspection PyUnresolvedReferences
+from . import scheduler
 
 
 app.parse_arguments()
 app.setup_custom_logger("root")
-client.setup_ca_cert()
 
-filename = os.path.dirname(os.path.abspath(__file__)) + "/samples/sample2.wav"
-with open(filename, 'rb') as audiofile:
-    audio = audiofile.read()
-text = client.recognize(audio=audio, language="ru-RU")
+
+async def main() -> str:
+    await client.open_http_session()
+    app.credential_pool = auth.create_credential_pool()
+    app.request_scheduler = scheduler.create_scheduler()
+    try:
+        filename = os.path.dirname(os.path.abspath(__file__)) + "/samples/sample2.wav"
+        with open(filename, 'rb') as audiofile:
+            audio = audiofile.read()
+        return await client.recognize(audio=audio, language="ru-RU")
+    finally:
+        await client.close_http_session()
+
+
+text = asyncio.run( main() )
 
 print(text)
@@ -1,17 +1,31 @@
 __package__ = 'wyoming_salutespeech_gateway'
 
-import os, wave
+import asyncio, os, wave
 # noinspection PyUnresolvedReferences
 from . import app
 # noinspection PyUnresolvedReferences
 from . import client
+# noinspection PyUnresolvedReferences
+from . import auth
+# noinspection PyUnresolvedReferences
+from . import scheduler
 
 
 app.parse_arguments()
 app.setup_custom_logger("root")
-client.setup_ca_cert()
 
-audio = client.synthesize(text="7 ежей.", language="ru-RU", voice="Ost_24000")
+
+async def main() -> bytes:
+    await client.open_http_session()
+    app.credential_pool = auth.create_credential_pool()
+    app.request_scheduler = scheduler.create_scheduler()
+    try:
+        return await client.synthesize(text="7 ежей.", language="ru-RU", voice="Ost_24000")
+    finally:
+        await client.close_http_session()
+
+
+audio = asyncio.run( main() )
 filename = os.path.dirname(os.path.abspath(__file__)) + "/samples/result.wav"
 #with open(filename, 'wb') as audiofile:
 #    audiofile.write(audio)
@@ -0,0 +1,40 @@
+__package__ = 'wyoming_salutespeech_gateway'
+
+""" Report the compression ratio and the encoding CPU cost of the upload codecs against the upload time saved """
+
+import os, sys, time, wave
+from wyoming.audio import AudioChunk, AudioChunkConverter
+# noinspection PyUnresolvedReferences
+from . import app
+# noinspection PyUnresolvedReferences
+from . import encoder
+
+
+UPLINK_BITRATE = 1_000_000  # In bits per second; a constrained site uplink
+
+app.parse_arguments()
+app.setup_custom_logger("root")
+
+audio = bytearray()
+for name in ("sample1.wav", "sample2.wav"):
+    filename = os.path.dirname(os.path.abspath(__file__)) + "/samples/" + name
+    wav_file: wave.Wave_read = wave.open(filename, "rb")
+    with wav_file:
+        chunk = AudioChunk(rate=wav_file.getframerate(), width=wav_file.getsampwidth(), channels=wav_file.getnchannels(), audio=wav_file.readframes(wav_file.getnframes()))
+    audio.extend( AudioChunkConverter(rate=16000, width=2, channels=1).convert(chunk).audio )
+audio = bytes(audio) * 4   # A typical voice command is several seconds long
+
+print(f"{len(audio) / 32000:.1f} seconds of audio, uplink {UPLINK_BITRATE / 1e6:.1f} Mbit/s")
+print(f"{'codec':>6} {'bytes':>8} {'ratio':>6} {'encode, ms':>11} {'upload, ms':>11} {'saved, ms':>10}")
+pcm_upload_time = len(audio) * 8 / UPLINK_BITRATE
+for codec in ("pcm", "flac", "opus"):
+    start_time = time.process_time()
+    for _ in range(10):
+        data, content_type = encoder.encode(audio, codec)
+    encode_time = (time.process_time() - start_time) / 10
+    if codec != "pcm" and content_type == encoder.PCM_CONTENT_TYPE:
+        print(f"{codec:>6} is not available", file=sys.stderr)
+        continue
+    upload_time = len(data) * 8 / UPLINK_BITRATE
+    saved_time = pcm_upload_time - upload_time - encode_time
+    print(f"{codec:>6} {len(data):>8} {len(audio) / len(data):>6.1f} {encode_time * 1000:>11.2f} {upload_time * 1000:>11.1f} {saved_time * 1000:>10.1f}")
@@ -0,0 +1,238 @@
+""" A load test of the gateway: many Wyoming clients against a local mock of the cloud services.
+Run from the repository root, like: python3 tests/load_test.py --clients 20 --iterations 10 --latency 0.3 --jitter 0.1 """
+
+import argparse
+import asyncio
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import time
+import wave
+
+from wyoming.asr import Transcript
+from wyoming.audio import AudioChunk, AudioStart, AudioStop
+from wyoming.client import AsyncTcpClient
+from wyoming.tts import Synthesize
+
+import mock_salutespeech
+
+
+ROOT_DIR = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+PHRASES = [
+    "Свет в гостиной включён.",
+    "Дверь открыта.",
+    "Температура в спальне двадцать два градуса, влажность сорок процентов.",
+    "Напоминаю: через десять минут начнётся встреча. Не забудьте взять ноутбук и зарядку.",
+]
+
+
+# region =============================================== Load generation
+
+def load_samples(trailing_silence: float) -> list[tuple[int, int, int, bytes]]:
+    """ Read the sample utterances as (rate, width, channels, audio), followed by the silence a satellite sends before it detects the end of speech """
+
+    samples = []
+    for filename in sorted( glob.glob(os.path.join(ROOT_DIR, "tests", "samples", "*.wav")) ):
+        wav_file: wave.Wave_read = wave.open(filename, "rb")
+        with wav_file:
+            rate, width, channels = wav_file.getframerate(), wav_file.getsampwidth(), wav_file.getnchannels()
+            silence = bytes( int(trailing_silence * rate) * width * channels )
+            samples.append( (rate, width, channels, wav_file.readframes(wav_file.getnframes()) + silence) )
+    return samples
+
+
+async def run_stt(wyoming_client: AsyncTcpClient, sample: tuple[int, int, int, bytes], realtime: bool) -> dict:
+    """ Send an utterance like a satellite does; the latency is from the end of the audio to the transcript """
+
+    rate, width, channels, audio = sample
+    bytes_per_chunk = 1024 * width * channels
+    await wyoming_client.write_event( AudioStart(rate=rate, width=width, channels=channels).event() )
+    for offset in range(0, len(audio), bytes_per_chunk):
+        await wyoming_client.write_event( AudioChunk(rate=rate, width=width, channels=channels, audio=audio[offset: offset + bytes_per_chunk]).event() )
+        if realtime:
+            await asyncio.sleep(1024 / rate)
+    start_time = time.perf_counter()
+    await wyoming_client.write_event( AudioStop().event() )
+    while True:
+        event = await wyoming_client.read_event()
+        if event is None:
+            raise ConnectionError("The gateway closed the connection")
+        if Transcript.is_type(event.type):
+            return {'kind': 'stt', 'latency': time.perf_counter() - start_time, 'ok': bool( Transcript.from_event(event).text )}
+
+
+async def run_tts(wyoming_client: AsyncTcpClient, text: str) -> dict:
+    """ Request a synthesis; the latency is until the last audio chunk, the first chunk time is recorded as well """
+
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    audio_size = 0
+    await wyoming_client.write_event( Synthesize(text=text).event() )
+    while True:
+        event = await wyoming_client.read_event()
+        if event is None:
+            raise ConnectionError("The gateway closed the connection")
+        if AudioChunk.is_type(event.type):
+            first_chunk_time = first_chunk_time or time.perf_counter() - start_time
+            audio_size += len(event.payload or b"")
+        elif AudioStop.is_type(event.type):
+            return {'kind': 'tts', 'latency': time.perf_counter() - start_time, 'first_chunk': first_chunk_time, 'ok': audio_size > 0}
+
+
+async def run_client(client_number: int, args: argparse.Namespace, samples: list) -> list[dict]:
+    """ Imitate a satellite making a series of requests over one connection """
+
+    results = []
+    async with AsyncTcpClient("127.0.0.1", args.gateway_port) as wyoming_client:
+        for iteration in range(args.iterations):
+            kind = args.mode if args.mode != "mixed" else ("stt", "tts")[(client_number + iteration) % 2]
+            try:
+                if kind == "stt":
+                    results.append( await run_stt(wyoming_client, samples[(client_number + iteration) % len(samples)], args.realtime) )
+                else:
+                    results.append( await run_tts(wyoming_client, PHRASES[(client_number + iteration) % len(PHRASES)]) )
+            except (ConnectionError, OSError) as err:
+                results.append( {'kind': kind, 'latency': 0.0, 'ok': False, 'error': str(err)} )
+                break
+    return results
+
+
+# endregion
+# region =============================================== Gateway process
+
+async def start_gateway(args: argparse.Namespace) -> subprocess.Popen:
+    """ Start the gateway against the mock services and wait until it listens. The mock keeps serving meanwhile """
+
+    command = [
+        sys.executable, os.path.join(ROOT_DIR, "src", "wyoming_salutespeech_gateway"),
+        "--listen-uri", f"tcp://127.0.0.1:{args.gateway_port}",
+        "--sber-auth-url", f"http://127.0.0.1:{args.mock_port}/api/v2/oauth",
+        "--salutespeech-url", f"http://127.0.0.1:{args.mock_port}/rest/v1",
+        "--auth-key", "load-test",
+        "--log-level", "WARNING",
+    ] + shlex.split(args.gateway_args)
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT_DIR, "src"))
+    process = subprocess.Popen(command, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The gateway exited with the code {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", args.gateway_port)
+            writer.close()
+            return process
+        except OSError:
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The gateway did not start listening in time")
+
+
+def get_process_tree(pid: int) -> list[int]:
+    """ Get the process and its descendants, like the worker processes of the gateway. Linux only """
+
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+            children = [int(child_pid) for child_pid in children_file.read().split()]
+    except OSError:
+        children = []
+    return [pid] + [descendant for child_pid in children for descendant in get_process_tree(child_pid)]
+
+
+def get_process_usage(pid: int) -> tuple[float, int]:
+    """ Get the CPU time in seconds and the peak RSS in bytes of a process with its descendants. Linux only """
+
+    cpu_time = 0.0
+    peak_rss = 0
+    for tree_pid in get_process_tree(pid):
+        with open(f"/proc/{tree_pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        cpu_time += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")   # utime + stime
+        with open(f"/proc/{tree_pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    peak_rss += int( line.split()[1] ) * 1024
+    return cpu_time, peak_rss
+
+
+# endregion
+# region =============================================== Report
+
+def percentile(values: list[float], share: float) -> float:
+    """ Get the nearest-rank percentile """
+
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[ min(len(ordered) - 1, max(0, int(round(share * len(ordered) + 0.5)) - 1)) ]
+
+
+def print_report(results: list[dict], duration: float, cpu_time: float, peak_rss: int, mock_stats: dict) -> None:
+    """ Print throughput, latency percentiles, the gateway resource usage and the cloud requests spent """
+
+    print(f"Requests: {len(results)}, failed: {sum(not result['ok'] for result in results)}, duration: {duration:.2f} s, throughput: {len(results) / duration:.1f} req/s")
+    print(f"{'':>18} {'count':>6} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8}")
+    rows = [
+        ("STT end-to-end", [result['latency'] for result in results if result['kind'] == 'stt' and result['ok']]),
+        ("TTS end-to-end", [result['latency'] for result in results if result['kind'] == 'tts' and result['ok']]),
+        ("TTS first chunk", [result['first_chunk'] for result in results if result['kind'] == 'tts' and result['ok']]),
+    ]
+    for name, values in rows:
+        if values:
+            print(f"{name:>18} {len(values):>6} {percentile(values, 0.50) * 1000:>8.0f} {percentile(values, 0.95) * 1000:>8.0f} {percentile(values, 0.99) * 1000:>8.0f}")
+    stt_count = sum(result['kind'] == 'stt' for result in results)
+    if stt_count:
+        print(f"Recognize requests per utterance: {(mock_stats['recognize'] + mock_stats['async_recognize']) / stt_count:.2f}")
+    print(f"Gateway CPU: {cpu_time:.2f} s ({cpu_time / duration * 100:.0f}% of one core), peak RSS: {peak_rss / 1024 / 1024:.1f} MB")
+    print(f"Cloud requests: {mock_stats['recognize']} recognize, {mock_stats['async_recognize']} async recognize ({mock_stats['task_polls']} polls), "
+          f"{mock_stats['synthesize']} synthesize, {mock_stats['oauth']} oauth, {mock_stats['errors']} injected errors, {mock_stats['quota_errors']} quota errors")
+
+
+# endregion
+# region =============================================== Entrypoint
+
+async def main(args: argparse.Namespace) -> None:
+    mock_runner = await mock_salutespeech.start(
+        "127.0.0.1", args.mock_port,
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status,
+        account_rps=args.account_rps
+    )
+    gateway = await start_gateway(args)
+    try:
+        await asyncio.sleep(args.warm_up)
+        warm_up_stats = dict(mock_runner.app['stats'])
+        samples = load_samples(args.trailing_silence)
+        start_cpu_time, _ = get_process_usage(gateway.pid)
+        start_time = time.perf_counter()
+        results_by_client = await asyncio.gather(*(run_client(number, args, samples) for number in range(args.clients)))
+        duration = time.perf_counter() - start_time
+        cpu_time, peak_rss = get_process_usage(gateway.pid)
+        print_report([result for results in results_by_client for result in results], duration, cpu_time - start_cpu_time, peak_rss,
+                     {name: count - warm_up_stats[name] for name, count in mock_runner.app['stats'].items()})
+    finally:
+        gateway.terminate()
+        gateway.wait()
+        await mock_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=10, help="Number of concurrent Wyoming clients")
+    parser.add_argument("--iterations", type=int, default=5, help="Number of requests per client")
+    parser.add_argument("--mode", default="mixed", choices=["stt", "tts", "mixed"])
+    parser.add_argument("--realtime", action="store_true", help="Send audio at the real-time pace, like a satellite does")
+    parser.add_argument("--trailing-silence", type=float, default=0.0, help="Silence appended to the sample utterances, in seconds, like a satellite sends before it stops the audio")
+    parser.add_argument("--latency", type=float, default=0.3, help="Mock cloud processing time, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Max random deviation of the mock latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the mock requests failed with an error")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of the injected errors")
+    parser.add_argument("--warm-up", type=float, default=0.0, help="Seconds to wait before the load, like to let the gateway pre-warm its TTS cache; not reported")
+    parser.add_argument("--account-rps", type=int, default=0, help="Mock request rate limit of an authorization key; 0 means no limit")
+    parser.add_argument("--gateway-port", type=int, default=10999)
+    parser.add_argument("--mock-port", type=int, default=10443)
+    parser.add_argument("--gateway-args", default="", help="Extra gateway options, like '--tts-streaming --vad'")
+    asyncio.run( main(parser.parse_args()) )
+
+
+# endregion
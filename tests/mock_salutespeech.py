@@ -0,0 +1,175 @@
+""" A local stand-in for the SberDevices authorization and SaluteSpeech REST services """
+
+import argparse
+import asyncio
+import random
+import time
+from collections import deque
+from uuid import uuid4
+
+from aiohttp import web
+
+
+RECOGNIZED_TEXT = "тестовая фраза"
+TOKEN_LIFETIME = 1800.0     # In seconds, like the real service
+
+
+async def _imitate_cloud(request: web.Request) -> web.Response | None:
+    """ Delay the response by the configured latency and jitter; return an error response if one is injected """
+
+    config = request.app['config']
+    if config['account_rps']:
+        account = request.app['accounts'].get( request.headers.get('Authorization', '').removeprefix('Bearer ') )
+        window = request.app['account_requests'].setdefault(account, deque())
+        while window and window[0] < time.time() - 1.0:
+            window.popleft()
+        if len(window) >= config['account_rps']:
+            request.app['stats']['quota_errors'] += 1
+            return web.json_response({'status': 429, 'message': 'Too many requests'}, status=429)
+        window.append( time.time() )
+    await asyncio.sleep( max(0.0, config['latency'] + random.uniform(-config['jitter'], config['jitter'])) )
+    if random.random() < config['error_rate']:
+        request.app['stats']['errors'] += 1
+        return web.json_response({'status': config['error_status'], 'message': 'Injected error'}, status=config['error_status'])
+    return None
+
+
+async def _handle_oauth(request: web.Request) -> web.Response:
+    """ Issue an access token """
+
+    await request.read()
+    request.app['stats']['oauth'] += 1
+    access_token = str( uuid4() )
+    request.app['accounts'][access_token] = request.headers.get('Authorization')
+    return web.json_response({
+        'access_token': access_token,
+        'expires_at': int( (time.time() + TOKEN_LIFETIME) * 1000 )
+    })
+
+
+async def _handle_recognize(request: web.Request) -> web.Response:
+    """ Receive the audio, possibly in chunks, and record the upload timings """
+
+    started_at = time.time()
+    first_byte_at = 0.0
+    size = 0
+    async for data in request.content.iter_any():
+        first_byte_at = first_byte_at or time.time()
+        size += len(data)
+    request.app['stats']['recognize'] += 1
+    request.app['recognize_requests'].append({
+        'chunked': request.headers.get('Transfer-Encoding') == 'chunked',
+        'content_type': request.headers.get('Content-Type'),
+        'size': size,
+        'started_at': started_at,
+        'first_byte_at': first_byte_at,
+        'completed_at': time.time(),
+    })
+    if error_response := await _imitate_cloud(request):
+        return error_response
+    return web.json_response({'result': [RECOGNIZED_TEXT], 'emotions': [], 'status': 200})
+
+
+async def _handle_synthesize(request: web.Request) -> web.Response:
+    """ Return silence, 0.05 seconds of 24 kHz audio per character of the text """
+
+    text = await request.text()
+    request.app['stats']['synthesize'] += 1
+    if error_response := await _imitate_cloud(request):
+        return error_response
+    return web.Response(body=bytes(2 * 1200 * len(text)), content_type='audio/x-pcm')
+
+
+async def _handle_upload(request: web.Request) -> web.Response:
+    """ Store the audio to recognize asynchronously """
+
+    audio = await request.read()
+    if error_response := await _imitate_cloud(request):
+        return error_response
+    request_file_id = str( uuid4() )
+    request.app['files'][request_file_id] = audio
+    return web.json_response({'status': 200, 'result': {'request_file_id': request_file_id}})
+
+
+async def _handle_async_recognize(request: web.Request) -> web.Response:
+    """ Create a recognition task completing in the configured latency per 10 seconds of audio """
+
+    options = await request.json()
+    request.app['stats']['async_recognize'] += 1
+    if error_response := await _imitate_cloud(request):
+        return error_response
+    audio = request.app['files'].get( options.get('request_file_id') )
+    if audio is None:
+        return web.json_response({'status': 400, 'message': 'File not found'}, status=400)
+    task_id = str( uuid4() )
+    audio_duration = len(audio) / 32000
+    request.app['tasks'][task_id] = {'id': task_id, 'status': 'NEW', 'done_at': time.time() + request.app['config']['latency'] * (1 + audio_duration / 10)}
+    return web.json_response({'status': 200, 'result': {'id': task_id, 'status': 'NEW'}})
+
+
+async def _handle_task(request: web.Request) -> web.Response:
+    """ Report the recognition task status """
+
+    request.app['stats']['task_polls'] += 1
+    task = request.app['tasks'].get( request.query.get('id') )
+    if task is None:
+        return web.json_response({'status': 404, 'message': 'Task not found'}, status=404)
+    if time.time() < task['done_at']:
+        return web.json_response({'status': 200, 'result': {'id': task['id'], 'status': 'RUNNING'}})
+    return web.json_response({'status': 200, 'result': {'id': task['id'], 'status': 'DONE', 'response_file_id': task['id']}})
+
+
+async def _handle_download(request: web.Request) -> web.Response:
+    """ Return the recognition result of a completed task """
+
+    if request.query.get('response_file_id') not in request.app['tasks']:
+        return web.json_response({'status': 404, 'message': 'File not found'}, status=404)
+    return web.json_response([{'results': [{'text': RECOGNIZED_TEXT, 'normalized_text': RECOGNIZED_TEXT}], 'eou': True, 'channel': 0}])
+
+
+def create_app(latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 500, account_rps: int = 0) -> web.Application:
+    """ Create the mock service. The latency and jitter are in seconds, the error rate is a share of failed requests.
+    The requests of an account (an authorization key) over the rate limit are rejected with 429, unless it is 0 """
+
+    mock_app = web.Application()
+    mock_app['config'] = {'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'error_status': error_status, 'account_rps': account_rps}
+    mock_app['stats'] = {'oauth': 0, 'recognize': 0, 'async_recognize': 0, 'task_polls': 0, 'synthesize': 0, 'errors': 0, 'quota_errors': 0}
+    mock_app['accounts'] = {}           # Authorization key by the access token
+    mock_app['account_requests'] = {}   # Request times within the last second by the authorization key
+    mock_app['recognize_requests'] = []
+    mock_app['files'] = {}      # Uploaded audio by the request file ID
+    mock_app['tasks'] = {}      # Asynchronous recognition tasks by the task ID
+    mock_app.router.add_post('/api/v2/oauth', _handle_oauth)
+    mock_app.router.add_post('/rest/v1/speech:recognize', _handle_recognize)
+    mock_app.router.add_post('/rest/v1/text:synthesize', _handle_synthesize)
+    mock_app.router.add_post('/rest/v1/data:upload', _handle_upload)
+    mock_app.router.add_post('/rest/v1/speech:async_recognize', _handle_async_recognize)
+    mock_app.router.add_get('/rest/v1/task:get', _handle_task)
+    mock_app.router.add_get('/rest/v1/data:download', _handle_download)
+    return mock_app
+
+
+async def start(host: str, port: int, **config) -> web.AppRunner:
+    """ Start the mock service in the running event loop """
+
+    runner = web.AppRunner( create_app(**config), access_log=None )
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+""" Entrypoint """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9443)
+    parser.add_argument("--latency", type=float, default=0.0, help="Cloud processing time, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Max random deviation of the latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the requests failed with an error, from 0 to 1")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of the injected errors")
+    parser.add_argument("--account-rps", type=int, default=0, help="Max requests per second of an authorization key; 0 means no limit")
+    args = parser.parse_args()
+    web.run_app(
+        create_app(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status, account_rps=args.account_rps),
+        host=args.host, port=args.port
+    )
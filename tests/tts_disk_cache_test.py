@@ -0,0 +1,47 @@
+""" Check that a disk cache item removed by another worker process between the lookup and the read is a miss, not an error.
+Run from the repository root, like: python3 tests/tts_disk_cache_test.py """
+
+__package__ = 'wyoming_salutespeech_gateway'
+
+import builtins
+import tempfile
+# noinspection PyUnresolvedReferences
+from . import app
+# noinspection PyUnresolvedReferences
+from . import tts_cache
+
+
+app.parse_arguments()
+app.setup_custom_logger("root")
+
+
+def read_racing(cache: tts_cache.DiskCache, key: str, remove) -> bytes | None:
+    """ Read the item, removing it right after the lookup, before the file is opened """
+
+    def racing_open(*args, **kwargs):
+        remove()
+        return builtins.open(*args, **kwargs)
+
+    tts_cache.open = racing_open    # Shadows the built-in for the cache module only
+    try:
+        return cache.get(key)
+    finally:
+        del tts_cache.open
+
+
+with tempfile.TemporaryDirectory() as directory:
+    cache = tts_cache.DiskCache(directory, max_bytes=1024 * 1024, ttl=3600.0)
+    other_worker_cache = tts_cache.DiskCache(directory, max_bytes=1024 * 1024, ttl=3600.0)
+    cache.open()
+    other_worker_cache.open()
+
+    # Evicted by a concurrent put of this process: both the file and the index entry are gone
+    cache.put('a1', b'audio')
+    assert read_racing(cache, 'a1', lambda: cache._remove('a1')) is None
+    # Evicted by another worker process: the file is gone, the index entry is stale
+    cache.put('b2', b'audio')
+    assert other_worker_cache.get('b2') == b'audio'
+    assert read_racing(cache, 'b2', lambda: other_worker_cache._remove('b2')) is None
+    assert cache.size == 0 and not cache.contains('b2')
+
+print("A removed item is a miss.")
@@ -0,0 +1,56 @@
+""" Check that a user joining a bulk synthesis waiting for a cloud slot raises its priority, with and without hedging.
+Run from the repository root, like: python3 tests/tts_promotion_test.py """
+
+__package__ = 'wyoming_salutespeech_gateway'
+
+import asyncio
+import sys
+# noinspection PyUnresolvedReferences
+from . import app
+# noinspection PyUnresolvedReferences
+from . import client
+# noinspection PyUnresolvedReferences
+from . import scheduler
+# noinspection PyUnresolvedReferences
+from . import tts_cache
+
+
+sys.argv += ["--max-concurrent-requests", "1", "--max-concurrent-tts-requests", "1", "--tts-output-format", "16000:2:1"]
+app.parse_arguments()
+app.setup_custom_logger("root")
+
+requested_texts = []
+
+
+async def request_locally(method: str, url: str, kind: str, priority: int, credential=None, **kwargs) -> tuple[int, bytes]:
+    """ Take a cloud slot like the client does and answer with silence """
+
+    async with app.request_scheduler.slot(kind, priority):
+        requested_texts.append( kwargs['data'].decode('utf-8') )
+        await asyncio.sleep(0.05)
+        return 200, bytes(24000 * 2)
+
+
+async def main() -> list[str]:
+    requested_texts.clear()
+    app.request_scheduler = scheduler.create_scheduler()
+    app.tts_audio_cache = tts_cache.TtsCache()
+    voice = app.cli_args.salutespeech_voice
+    output_format = app.cli_args.tts_output_format
+    tasks = [asyncio.create_task( tts_cache.synthesize("Занято.", "ru-RU", voice, output_format) )]
+    await asyncio.sleep(0.01)
+    tasks += [asyncio.create_task( tts_cache.synthesize(f"Фраза {number}.", "ru-RU", voice, output_format, scheduler.PRIORITY_BULK) ) for number in range(3)]
+    await asyncio.sleep(0.01)
+    tasks.append( asyncio.create_task(tts_cache.synthesize("Объявление.", "ru-RU", voice, output_format)) )
+    await asyncio.sleep(0.01)
+    tasks.append( asyncio.create_task(tts_cache.synthesize("Фраза 2.", "ru-RU", voice, output_format, scheduler.PRIORITY_INTERACTIVE)) )
+    await asyncio.gather(*tasks)
+    return requested_texts
+
+
+client._request = request_locally
+for hedging in (False, True):
+    app.cli_args.hedging = hedging
+    order = asyncio.run( main() )
+    print(f"Hedging: {hedging}, the order of the cloud requests: {order}")
+    assert order[1] == "Фраза 2."